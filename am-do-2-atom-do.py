@@ -1,35 +1,54 @@
+import argparse
+import contextlib
+import csv
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
 import os
+import random
+import re
 import shutil
+import socket
 import sys
+import threading
+import time
+import zlib
 import pymysql.cursors
 import requests
 import metsrw
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from lxml import etree
+from urllib.parse import unquote_plus
 
 # Set connection parameters.
-STORAGE_SERVICE_URL = ''
-STORAGE_SERVICE_USER = ''
-STORAGE_SERVICE_API_KEY = ''
-ATOM_MYSQL_USER = ''
-ATOM_MYSQL_PASSWORD = ''
-ATOM_MYSQL_DATABASE = ''
-
-# Set and test MySQL connection.
-try:
+STORAGE_SERVICE_URL = os.environ.get("ARCHIVEMATICA_SS_URL", '')
+STORAGE_SERVICE_USER = os.environ.get("ARCHIVEMATICA_SS_USER", '')
+STORAGE_SERVICE_API_KEY = os.environ.get("ARCHIVEMATICA_SS_KEY", '')
+ATOM_MYSQL_USER = os.environ.get("ATOM_MYSQL_USER", '')
+ATOM_MYSQL_PASSWORD = os.environ.get("ATOM_MYSQL_PASSWORD", '')
+ATOM_MYSQL_DATABASE = os.environ.get("ATOM_MYSQL_DATABASE", '')
+
+# The AtoM MySQL connection is opened by main(). METS parser processes
+# import this script too and must never use it.
+mysqlConnection = None
+mysqlCursor = None
+
+
+def connect_atom_database(cursorclass=pymysql.cursors.DictCursor):
     # Configure AtoM MySQL connection.
-    mysqlConnection = pymysql.connect(
+    return pymysql.connect(
         host="localhost",
         user=ATOM_MYSQL_USER,
         password=ATOM_MYSQL_PASSWORD,
         db=ATOM_MYSQL_DATABASE,
         charset="utf8mb4",
-        cursorclass=pymysql.cursors.DictCursor,
+        cursorclass=cursorclass,
     )
-    mysqlCursor = mysqlConnection.cursor()
-    print("Connected to AtoM MySQL database.")
-except Exception as e:
-    print(e)
-    sys.exit("Unable to connect to the AtoM MySQL database. Please check your connection parameters.")
+
 
 # Delete temporary MySQL working table and METS download directory?
 # This is False by default as this info may be useful for any post-script
@@ -39,45 +58,561 @@ DELETE_TEMP_FILES = False
 # Set METS download directory.
 METS_DIR = "DIP_METS/"
 
-# Create a working directory for downloading METS files.
-if not os.path.exists(METS_DIR):
-    os.makedirs(METS_DIR)
+# The METS download directory doubles as a cache between runs. Each cached
+# METS file is recorded in an append-only manifest, keyed by AIP UUID, with
+# its size, checksum, Storage Service `current_path` and AIP name.
+METS_MANIFEST = os.path.join(METS_DIR, "manifest.jsonl")
+
+# Maximum total size in bytes of the METS files kept in METS_DIR. Once the
+# cache grows past this size, the least recently used METS files of
+# already parsed AIPs are deleted. None keeps every METS file.
+METS_CACHE_MAX_BYTES = None
+
+# Re-compute the checksum of cached METS files before re-using them. By
+# default only the file size is compared against the manifest.
+VERIFY_METS_CACHE = False
+
+# Parser used to read METS files. "iterparse" streams the METS file and
+# keeps only the values needed for the working table, falling back to
+# METSRW if it fails. "metsrw" always builds the full METSRW document.
+METS_PARSER = "iterparse"
+
+# The records parsed from each cached METS file are kept next to it in
+# METS.<uuid>.index.json, tied to the checksum of the METS file, so later
+# runs read the index instead of the METS XML. Indexes written with another
+# version are ignored and rebuilt.
+METS_INDEX_VERSION = 2
+
+METS_NS = "{http://www.loc.gov/METS/}"
+XLINK_NS = "{http://www.w3.org/1999/xlink}"
+
+# Number of METS files downloaded from the Storage Service in parallel.
+DOWNLOAD_WORKERS = 4
+
+# Seconds to wait for the Storage Service to accept a connection, and to
+# send each part of a response.
+STORAGE_SERVICE_TIMEOUT = (10, 120)
+
+# Storage Service requests failing with a server error (5xx), a dropped
+# connection or a timeout are retried up to this many times. Each retry
+# waits a random time of up to STORAGE_SERVICE_BACKOFF seconds, doubled
+# after every attempt.
+STORAGE_SERVICE_RETRIES = 4
+STORAGE_SERVICE_BACKOFF = 1.0
+
+# The number of concurrent Storage Service requests starts at 1 and grows
+# while responses stay fast, up to DOWNLOAD_WORKERS. It shrinks when a
+# response takes this many times longer than the fastest response of the
+# same kind so far, and is halved on failed requests.
+STORAGE_SERVICE_SLOW_RESPONSE = 3.0
+
+# Credentials in a Storage Service URL, to be masked in error messages.
+STORAGE_SERVICE_CREDENTIALS = re.compile(r"((?:username|api_key)=)[^&\s'\")]*")
+
+# Size in bytes of the chunks in which METS files are written to disk.
+METS_DOWNLOAD_CHUNK_SIZE = 1048576
+
+# Number of METS files fetched from compressed (.7z) AIPs in parallel. The
+# Storage Service unpacks the whole package for each of these requests, so
+# they are capped separately, within DOWNLOAD_WORKERS.
+COMPRESSED_DOWNLOAD_WORKERS = 2
+
+# A directory of pre-staged METS files, or a mounted AIP store, to read
+# METS files from instead of the Storage Service. METS files are found at
+# <AIP name>-<AIP UUID>/data/METS.<AIP UUID>.xml anywhere below it, or as
+# METS.<AIP UUID>.xml files, such as the METS_DIR of another host, whose
+# AIP names are read from a manifest.jsonl next to them if there is one.
+# Compressed (.7z) AIPs are not unpacked locally. AIPs that are not found
+# are fetched from the Storage Service, unless ARCHIVEMATICA_SS_URL is
+# empty, which makes the run fully offline.
+LOCAL_METS_SOURCE = None
+
+AIP_DIRECTORY = re.compile(r"^(.+)-([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})$")
+METS_FILE_NAME = re.compile(r"^METS\.([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\.xml$")
+
+# Number of AIPs queued for download ahead of the METS parser. METS files
+# are fetched in the background while earlier AIPs are being parsed.
+DOWNLOAD_PREFETCH = DOWNLOAD_WORKERS * 2
+
+# Number of processes parsing downloaded METS files in parallel.
+PARSE_WORKERS = os.cpu_count() or 1
+
+# Number of parsed working table records written to dip_files per commit.
+PARSE_WRITE_BATCH_SIZE = 1000
+
+# Number of digital objects whose properties are replaced in a single
+# transaction. Each chunk is committed once, or not at all.
+WRITE_CHUNK_SIZE = 500
+
+# The AtoM 2.7 properties written for each digital object, as (scope,
+# name, dip_files column).
+DIGITAL_OBJECT_PROPERTIES = [
+    ("Archivematica AIP", "objectUUID", "object_uuid"),
+    ("Archivematica AIP", "aipUUID", "aip_uuid"),
+    ("Archivematica AIP", "relativePathWithinAip", "relativePathWithinAip"),
+    ("Archivematica AIP", "aipName", "aipName"),
+    ("Archivematica AIP", "originalFileName", "originalFileName"),
+    ("Archivematica AIP", "originalFileSize", "originalFileSize"),
+    ("Archivematica AIP", "originalFileIngestedAt", "originalFileIngestedAt"),
+    ("Archivematica AIP", "preservationCopyFileName", "preservationCopyFileName"),
+    ("Archivematica AIP", "preservationCopyFileSize", "preservationCopyFileSize"),
+    ("Archivematica AIP", "preservationCopyNormalizedAt", "preservationCopyNormalizedAt"),
+    ("premisData", "formatName", "formatName"),
+    ("premisData", "formatVersion", "formatVersion"),
+    ("premisData", "formatRegistryName", "formatRegistryName"),
+    ("premisData", "formatRegistryKey", "formatRegistryKey"),
+]
+
+# Every PREMIS event of a digital object's original file is also written as
+# a property, PHP serialized like AtoM 2.7 does for DIP uploads, under this
+# name in the "premisData" scope. Other event types use PREMIS_OTHER_EVENT.
+PREMIS_EVENT_PROPERTIES = {
+    "format identification": "formatIdentificationEvent",
+}
+PREMIS_OTHER_EVENT = "otherEvent"
+
+# Compare the parsed values with the existing properties of each digital
+# object and only write the ones that differ, instead of deleting and
+# rewriting all of them. Properties that match are left untouched.
+WRITE_CHANGED_ONLY = False
+
+# Compare the parsed values with the existing properties and report the
+# differences without changing the property tables or marking any digital
+# object as written. Re-run with --resume to write them.
+DRY_RUN = False
+
+# The property differences found with WRITE_CHANGED_ONLY or DRY_RUN are
+# listed in this CSV report, one row per added, changed or removed property.
+PROPERTY_DIFF_REPORT = "property_changes.csv"
+
+# Legacy digital objects whose object or AIP UUID could not be found in the
+# AtoM property tables are listed in this CSV report.
+UNRESOLVED_REPORT = "unresolved_dip_files.csv"
+
+# Legacy digital objects that are left unparsed, because their METS file
+# could not be downloaded or parsed or does not list them, keep their
+# existing properties and are listed in this CSV report.
+UNPARSED_REPORT = "unparsed_dip_files.csv"
+
+# The slice of AIPs processed by this host, as (index, count), when the
+# migration is split across several hosts with --shard. None processes
+# every AIP.
+SHARD = None
+
+# Timings and counters of each phase are written to this run report, as
+# JSON, or as one row per metric if the name ends in ".csv". The report is
+# rewritten as each phase finishes. None disables it.
+RUN_REPORT = "run_report.json"
+
+# Replace the per-AIP progress messages with a single line that is updated
+# in place and gives an estimated time of completion.
+LIVE_PROGRESS = False
 
 # Initialize a crude, global error counter. Pre-mature exits are not counted.
 ERROR_COUNT = 0
 
-# Test Storage Service connection
-try:
-    request_url = STORAGE_SERVICE_URL + "?username=" + STORAGE_SERVICE_USER + "&api_key=" + STORAGE_SERVICE_API_KEY
-    response = requests.get(request_url)
-    if response.status_code != requests.codes.ok:
+# Cached METS files, keyed by AIP UUID. The manifest is shared by the
+# download workers and guarded by a lock.
+mets_manifest = {}
+mets_manifest_lock = threading.Lock()
+
+# The total size of the cached METS files, and a heap of (last_used, AIP
+# UUID) for eviction, least recently used first. Both are guarded by the
+# manifest lock. Heap items whose last_used is out of date are skipped.
+# Items of AIPs still waiting to be parsed are held back by eviction, as
+# AIP UUID: last_used, until the AIP is done.
+mets_cache_size = 0
+mets_cache_heap = []
+mets_cache_deferred = {}
+
+# Timings and counters of the run, keyed by phase, for the RUN_REPORT.
+run_stats = {}
+
+# Pre-staged METS files found in LOCAL_METS_SOURCE, keyed by AIP UUID, as
+# (path, AIP name).
+local_mets_index = {}
+
+# Limits the download workers fetching from compressed AIPs at once. Set up
+# by parse_downloaded_aips().
+compressed_downloads = None
+
+# Adaptive limit of concurrent Storage Service requests, with the fastest
+# response time seen for each kind of request and request totals for the
+# RUN_REPORT. Guarded by storage_service_condition, which wakes up workers
+# waiting for a free slot.
+storage_service_limit = {"limit": 1.0, "active": 0, "fastest": {}, "requests": 0, "retries": 0, "failures": 0}
+storage_service_condition = threading.Condition()
+
+# Each download worker keeps its own Storage Service session so that
+# keep-alive connections are pooled and reused across requests.
+storage_service_sessions = threading.local()
+
+
+def get_storage_service_session():
+    session = getattr(storage_service_sessions, "session", None)
+    if session is None:
+        session = requests.Session()
+        storage_service_sessions.session = session
+    return session
+
+
+def acquire_storage_service_slot():
+    with storage_service_condition:
+        while storage_service_limit["active"] >= int(storage_service_limit["limit"]):
+            storage_service_condition.wait()
+        storage_service_limit["active"] += 1
+
+
+def release_storage_service_slot(kind, latency):
+    '''
+    Free a request slot and adapt the limit to the outcome of the request:
+    one more slot per full window of fast responses, one less per window of
+    slow responses, and half as many after a failure. `latency` is None for
+    failed requests.
+    '''
+    with storage_service_condition:
+        limit = storage_service_limit
+        limit["active"] -= 1
+        limit["requests"] += 1
+        if latency is None:
+            limit["failures"] += 1
+            limit["limit"] = max(1.0, limit["limit"] / 2)
+        else:
+            fastest = min(latency, limit["fastest"].get(kind, latency))
+            limit["fastest"][kind] = fastest
+            # Responses within a few tens of milliseconds count as fast,
+            # however quick the fastest one was.
+            if latency > STORAGE_SERVICE_SLOW_RESPONSE * max(fastest, 0.05):
+                limit["limit"] = max(1.0, limit["limit"] - 1 / limit["limit"])
+            else:
+                limit["limit"] = min(float(DOWNLOAD_WORKERS), limit["limit"] + 1 / limit["limit"])
+        storage_service_condition.notify_all()
+
+
+def storage_service_request(request_url, kind, handle_response):
+    '''
+    GET a Storage Service URL within the adaptive concurrency limit and
+    return the result of handle_response(response), which reads the
+    response while the request still holds its slot. Server errors, dropped
+    connections and timeouts, also while reading the response, are retried
+    with exponential backoff and jitter. Once the retries are used up the
+    last error is raised.
+    '''
+    for attempt in range(STORAGE_SERVICE_RETRIES + 1):
+        if attempt:
+            with storage_service_condition:
+                storage_service_limit["retries"] += 1
+            time.sleep(random.uniform(0, STORAGE_SERVICE_BACKOFF * 2 ** (attempt - 1)))
+        acquire_storage_service_slot()
+        latency = None
+        try:
+            with get_storage_service_session().get(request_url, timeout=STORAGE_SERVICE_TIMEOUT, stream=True) as response:
+                if response.status_code >= 500:
+                    # The URL holds the API key, so it is left out.
+                    error = requests.HTTPError("Storage Service responded with " + str(response.status_code) + " " + response.reason)
+                    continue
+                latency = response.elapsed.total_seconds()
+                return handle_response(response)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            latency = None
+            # Connection errors quote the URL, which holds the API key.
+            error = type(e)(STORAGE_SERVICE_CREDENTIALS.sub(r"\1...", str(e)))
+        finally:
+            release_storage_service_slot(kind, latency)
+    raise error
+
+
+def connect():
+    global mysqlConnection, mysqlCursor
+
+    # Set and test MySQL connection.
+    try:
+        mysqlConnection = connect_atom_database()
+        mysqlCursor = mysqlConnection.cursor()
+        print("Connected to AtoM MySQL database.")
+    except Exception as e:
+        print(e)
+        sys.exit("Unable to connect to the AtoM MySQL database. Please check your connection parameters.")
+
+
+def connect_storage_service():
+    # Create a working directory for downloading METS files.
+    if not os.path.exists(METS_DIR):
+        os.makedirs(METS_DIR)
+
+    if not STORAGE_SERVICE_URL and LOCAL_METS_SOURCE:
+        print("No Storage Service URL set. Only the METS files in " + LOCAL_METS_SOURCE + " are used.")
+        return
+
+    # Test Storage Service connection
+    try:
+        request_url = STORAGE_SERVICE_URL + "?username=" + STORAGE_SERVICE_USER + "&api_key=" + STORAGE_SERVICE_API_KEY
+        status_code = storage_service_request(request_url, "connection test", lambda response: response.status_code)
+        if status_code != requests.codes.ok:
+            sys.exit("Unable to connect to Archivematica Storage Service. Please check your connection parameters.")
+        else:
+            print("Connected to Archivematica Storage Service.")
+    except Exception as e:
+        print(e)
         sys.exit("Unable to connect to Archivematica Storage Service. Please check your connection parameters.")
-    else:
-        print("Connected to Archivematica Storage Service.")
-except Exception as e:
-    print(e)
-    sys.exit("Unable to connect to Archivematica Storage Service. Please check your connection parameters.")
-
-# Create a working table for transferring the legacy DIP file properties.
-try:
-    sql = "DROP TABLE IF EXISTS dip_files, premis_events;"
-    mysqlCursor.execute(sql)
-    mysqlConnection.commit()
-    sql = "CREATE TABLE IF NOT EXISTS dip_files(object_id INTEGER PRIMARY KEY, object_uuid TEXT, aip_uuid TEXT, originalFileIngestedAt TEXT, relativePathWithinAip TEXT, aipName TEXT, originalFileName TEXT, originalFileSize TEXT, formatName TEXT, formatVersion TEXT, formatRegistryName TEXT, formatRegistryKey TEXT, preservationCopyNormalizedAt TEXT, preservationCopyFileName TEXT, preservationCopyFileSize TEXT, parsed BOOLEAN);"
+
+
+def create_working_tables(resume):
+    # Create a working table for transferring the legacy DIP file properties.
+    # A resumed run keeps the working tables of the interrupted run.
+    try:
+        if not resume:
+            sql = "DROP TABLE IF EXISTS dip_files, premis_events, aip_status, shard_status;"
+            mysqlCursor.execute(sql)
+            mysqlConnection.commit()
+        sql = "CREATE TABLE IF NOT EXISTS dip_files(object_id INTEGER PRIMARY KEY, object_uuid CHAR(36) NOT NULL, aip_uuid CHAR(36) NOT NULL, originalFileIngestedAt TEXT, relativePathWithinAip TEXT, aipName TEXT, originalFileName TEXT, originalFileSize TEXT, formatName TEXT, formatVersion TEXT, formatRegistryName TEXT, formatRegistryKey TEXT, preservationCopyNormalizedAt TEXT, preservationCopyFileName TEXT, preservationCopyFileSize TEXT, parsed BOOLEAN NOT NULL DEFAULT FALSE, written BOOLEAN NOT NULL DEFAULT FALSE, shard INTEGER NOT NULL DEFAULT 0, INDEX dip_files_aip_uuid_parsed (aip_uuid, parsed), INDEX dip_files_shard (shard, parsed, written));"
+        mysqlCursor.execute(sql)
+        # The PREMIS events of each digital object, as zlib compressed JSON.
+        sql = "CREATE TABLE IF NOT EXISTS premis_events(object_id INTEGER PRIMARY KEY, event_count INTEGER NOT NULL, events MEDIUMBLOB NOT NULL);"
+        mysqlCursor.execute(sql)
+        # The furthest phase each AIP has completed, so that an interrupted
+        # run can be resumed without repeating finished work, and where the
+        # Storage Service keeps it. Rows of both tables record the shard of
+        # their AIP, so that each host only reads and locks its own rows.
+        sql = "CREATE TABLE IF NOT EXISTS aip_status(aip_uuid CHAR(36) PRIMARY KEY, phase ENUM('extracted', 'downloaded', 'parsed', 'written') NOT NULL DEFAULT 'extracted', current_path TEXT, location VARCHAR(255), compressed BOOLEAN, shard INTEGER NOT NULL DEFAULT 0, INDEX aip_status_shard (shard, phase));"
+        mysqlCursor.execute(sql)
+        # The progress and error count of each host taking part in the run.
+        sql = "CREATE TABLE IF NOT EXISTS shard_status(shard VARCHAR(32) PRIMARY KEY, host VARCHAR(255), phase VARCHAR(32), errors INTEGER NOT NULL DEFAULT 0, updated_at DATETIME);"
+        mysqlCursor.execute(sql)
+        mysqlConnection.commit()
+    except Exception as e:
+        print(e)
+        sys.exit("Unable to create working table. Check permissions for MySQL user.")
+
+
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected INDEX/COUNT, e.g. 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError("INDEX must be between 0 and COUNT - 1")
+    return index, count
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Update pre release 2.7 AtoM digital objects with information from Archivematica AIP METS files.")
+    parser.add_argument("--resume", action="store_true", help="keep the working tables of an interrupted run and only process the AIPs it did not finish")
+    parser.add_argument("--shard", type=parse_shard, metavar="INDEX/COUNT", help="only process the AIPs whose UUID hashes to INDEX out of COUNT hosts; implies --resume")
+    parser.add_argument("--coordinator", action="store_true", help="print the combined progress and error totals of all hosts and exit")
+    parser.add_argument("--report", default=RUN_REPORT, metavar="PATH", help="write per-phase timings and counters to this JSON or .csv file (default: %(default)s)")
+    parser.add_argument("--mets-source", default=LOCAL_METS_SOURCE, metavar="DIR", help="read METS files from this directory of pre-staged METS files or mounted AIP store before asking the Storage Service; compressed (.7z) AIPs are not read locally")
+    parser.add_argument("--progress", action="store_true", default=LIVE_PROGRESS, help="show a single live progress line with an ETA instead of per-AIP messages")
+    parser.add_argument("--changed-only", action="store_true", default=WRITE_CHANGED_ONLY, help="only write the properties that differ from the existing ones and list the differences in " + PROPERTY_DIFF_REPORT)
+    parser.add_argument("--dry-run", action="store_true", default=DRY_RUN, help="list the property differences in " + PROPERTY_DIFF_REPORT + " without changing any property; re-run with --resume to write them")
+    return parser.parse_args()
+
+
+def shard_filter(column):
+    # SQL condition selecting the AIPs of this host's shard by a hash of the
+    # AIP UUID, so every host derives the same disjoint slices. Used when
+    # extracting legacy objects from the property tables.
+    if SHARD is None:
+        return ""
+    return " AND MOD(CRC32(" + column + "), " + str(SHARD[1]) + ") = " + str(SHARD[0])
+
+
+def working_shard_filter(column="shard"):
+    # SQL condition selecting the working table rows of this host's shard
+    # by their indexed shard column, so hosts never scan each other's rows.
+    if SHARD is None:
+        return ""
+    return " AND " + column + " = " + str(SHARD[0])
+
+
+def shard_label():
+    index, count = SHARD or (0, 1)
+    return str(index) + "/" + str(count)
+
+
+def record_shard_status(phase):
+    # Runs in the caller's transaction, which commits it.
+    sql = "INSERT INTO shard_status (shard, host, phase, errors, updated_at) VALUES (%s, %s, %s, %s, NOW()) ON DUPLICATE KEY UPDATE host = VALUES(host), phase = VALUES(phase), errors = VALUES(errors), updated_at = VALUES(updated_at);"
+    mysqlCursor.execute(sql, (shard_label(), socket.gethostname(), phase, ERROR_COUNT))
+
+
+def print_coordinator_report():
+    '''
+    Print the progress and error totals of every host that has taken part
+    in the run, as recorded in the shared working tables.
+    '''
+    try:
+        sql = "SELECT * FROM shard_status ORDER BY shard;"
+        mysqlCursor.execute(sql)
+        shards = mysqlCursor.fetchall()
+    except Exception as e:
+        print(e)
+        sys.exit("Unable to query the working tables. Has a migration run been started?")
+    shard_count = max([int(row["shard"].split("/")[1]) for row in shards] or [1])
+
+    sql = "SELECT shard AS shard_index, phase, COUNT(*) AS aip_count FROM aip_status GROUP BY shard, phase;"
     mysqlCursor.execute(sql)
-    sql = "CREATE TABLE IF NOT EXISTS premis_events(id INTEGER PRIMARY KEY, object_id INTEGER, value TEXT);"
+    aip_phases = {}
+    for row in mysqlCursor.fetchall():
+        aip_phases.setdefault(row["shard_index"], {})[row["phase"]] = row["aip_count"]
+
+    sql = "SELECT shard AS shard_index, COUNT(*) AS file_count, SUM(parsed) AS parsed_count, SUM(written) AS written_count FROM dip_files GROUP BY shard;"
     mysqlCursor.execute(sql)
-    mysqlConnection.commit()
-except Exception as e:
-    print(e)
-    sys.exit("Unable to create working table. Check permissions for MySQL user.")
+    file_counts = {row["shard_index"]: row for row in mysqlCursor.fetchall()}
+
+    phase_names = ["extracted", "downloaded", "parsed", "written"]
+    totals = dict.fromkeys(phase_names + ["files", "parsed_files", "written_files", "errors"], 0)
+    shard_status = {row["shard"]: row for row in shards}
+    for index in range(shard_count):
+        label = str(index) + "/" + str(shard_count)
+        status = shard_status.get(label, {})
+        phases = aip_phases.get(index, {})
+        files = file_counts.get(index, {})
+        for phase in phase_names:
+            totals[phase] += phases.get(phase, 0)
+        totals["files"] += files.get("file_count", 0)
+        totals["parsed_files"] += int(files.get("parsed_count") or 0)
+        totals["written_files"] += int(files.get("written_count") or 0)
+        totals["errors"] += status.get("errors", 0)
+        print("Shard " + label + " on " + str(status.get("host", "-")) + ": " + str(status.get("phase", "not started")) + ", updated " + str(status.get("updated_at", "-")))
+        print("  AIPs: " + ", ".join(phase + " " + str(phases.get(phase, 0)) for phase in phase_names))
+        print("  Digital objects: " + str(int(files.get("parsed_count") or 0)) + " parsed and " + str(int(files.get("written_count") or 0)) + " written of " + str(files.get("file_count", 0)) + ", errors " + str(status.get("errors", 0)))
+    print("All shards:")
+    print("  AIPs: " + ", ".join(phase + " " + str(totals[phase]) for phase in phase_names))
+    print("  Digital objects: " + str(totals["parsed_files"]) + " parsed and " + str(totals["written_files"]) + " written of " + str(totals["files"]))
+    print("  Number of errors encountered: " + str(totals["errors"]))
+
+
+def phase_stats(phase):
+    return run_stats.setdefault(phase, {})
+
+
+def count_phase(phase, **counters):
+    stats = phase_stats(phase)
+    for name, value in counters.items():
+        stats[name] = stats.get(name, 0) + value
+
+
+def time_phase(phase, start):
+    # Add the wall clock time since start to the phase.
+    count_phase(phase, seconds=time.monotonic() - start)
+
+
+def record_latency(phase, seconds):
+    # Per-AIP timings of a phase, reported as percentiles.
+    count_phase(phase, aips=1, busy_seconds=seconds)
+    phase_stats(phase).setdefault("latencies", []).append(seconds)
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a sorted list.
+    return values[max(0, int(round(fraction * len(values))) - 1)]
+
 
+def summarize_phase(stats):
+    summary = {name: value for name, value in stats.items() if name != "latencies"}
+    latencies = sorted(stats.get("latencies", []))
+    if latencies:
+        summary["latency_mean"] = sum(latencies) / len(latencies)
+        for name, fraction in (("latency_p50", 0.5), ("latency_p90", 0.9), ("latency_p99", 0.99)):
+            summary[name] = percentile(latencies, fraction)
+        summary["latency_max"] = latencies[-1]
+    # Throughput over the wall clock time of the phase.
+    seconds = stats.get("seconds")
+    if seconds:
+        for name in ("aips", "files", "bytes", "rows"):
+            if name in stats:
+                summary[name + "_per_second"] = stats[name] / seconds
+    # Phases run by a pool of workers alongside each other report how busy
+    # the pool was, which shows where the pipeline is waiting.
+    if "workers" in stats and "busy_seconds" in stats and stats.get("stage_seconds"):
+        summary["utilization"] = stats["busy_seconds"] / (stats["workers"] * stats["stage_seconds"])
+    return summary
 
-def main():
+
+def write_run_report(run_start):
+    '''
+    Write the timings and counters gathered so far to the RUN_REPORT. Every
+    value is a total for the run, so the report can be rewritten at will.
+    '''
+    if not RUN_REPORT:
+        return
+    with storage_service_condition:
+        if storage_service_limit["requests"]:
+            phase_stats("storage_service").update({
+                "requests": storage_service_limit["requests"],
+                "retries": storage_service_limit["retries"],
+                "failures": storage_service_limit["failures"],
+                "concurrency_limit": int(storage_service_limit["limit"]),
+            })
+    report = {
+        "host": socket.gethostname(),
+        "shard": shard_label(),
+        "started_at": run_start.strftime("%Y-%m-%d %H:%M:%S"),
+        "updated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "seconds": (datetime.now() - run_start).total_seconds(),
+        "errors": ERROR_COUNT,
+        "phases": {phase: summarize_phase(stats) for phase, stats in run_stats.items()},
+    }
+    try:
+        with open(RUN_REPORT, "w", newline="") as report_file:
+            if RUN_REPORT.endswith(".csv"):
+                writer = csv.writer(report_file)
+                writer.writerow(["phase", "metric", "value"])
+                for name, value in report.items():
+                    if name != "phases":
+                        writer.writerow(["run", name, value])
+                for phase, summary in report["phases"].items():
+                    for name, value in summary.items():
+                        writer.writerow([phase, name, value])
+            else:
+                json.dump(report, report_file, indent=2)
+    except Exception as e:
+        print("Unable to write the run report to " + RUN_REPORT)
+        print(e)
+
+
+def print_progress(label, done, total, start):
+    # Redraw the live progress line, with an ETA extrapolated from the rate
+    # so far.
+    line = label + ": " + str(done) + " of " + str(total)
+    if done and total:
+        elapsed = time.monotonic() - start
+        remaining = elapsed / done * (total - done)
+        line += " ({:.0%}), ETA ".format(done / total) + str(timedelta(seconds=int(remaining)))
+    print("\r" + line.ljust(79), end="", flush=True)
+    if done >= total:
+        print()
+
+
+def main(args):
     '''
     Update pre release 2.7 AtoM digital objects with information from AIP
     METS to take full advantage of the digital object metadata enhancement and AIP/file retrieval features.
     '''
+    global SHARD, RUN_REPORT, LIVE_PROGRESS, LOCAL_METS_SOURCE, WRITE_CHANGED_ONLY, DRY_RUN
+
+    connect()
+    if args.coordinator:
+        print_coordinator_report()
+        return
+
+    # Hosts sharing a run must never drop each other's working tables.
+    SHARD = args.shard
+    RUN_REPORT = args.report
+    LIVE_PROGRESS = args.progress
+    LOCAL_METS_SOURCE = args.mets_source
+    WRITE_CHANGED_ONLY = args.changed_only
+    DRY_RUN = args.dry_run
+    connect_storage_service()
+    if LOCAL_METS_SOURCE:
+        compressed_count = index_local_mets_source()
+        print("Found " + str(len(local_mets_index)) + " pre-staged METS files in " + LOCAL_METS_SOURCE + ".")
+        if compressed_count:
+            print("Found " + str(compressed_count) + " compressed AIPs in " + LOCAL_METS_SOURCE + ", which are not read locally. Their METS files are fetched from the Storage Service.")
+    create_working_tables(resume=args.resume or SHARD is not None)
+    if SHARD is not None:
+        print("Processing shard " + shard_label() + " of the legacy AIPs.")
 
     # Count total number of digital objects in AtoM.
     sql = "SELECT COUNT(*) FROM digital_object WHERE object_id IS NOT NULL;"
@@ -85,10 +620,9 @@ def main():
     total_count = mysqlCursor.fetchone()
 
     # Count total number of 'legacy' digital objects in AtoM.
-    sql = "SELECT * FROM property WHERE name='objectUUID' AND scope is NULL;"
+    sql = "SELECT COUNT(*) FROM property WHERE name='objectUUID' AND scope is NULL;"
     mysqlCursor.execute(sql)
-    legacy_dip_files = mysqlCursor.fetchall()
-    legacy_count = len(legacy_dip_files)
+    legacy_count = mysqlCursor.fetchone()["COUNT(*)"]
 
     print("Total number of digital objects in AtoM: " + str(total_count["COUNT(*)"]))
     print("Total number of 'legacy` digital objects to be updated: " + str(legacy_count))
@@ -96,28 +630,49 @@ def main():
     script_start = datetime.now().replace(microsecond=0)
     print("Script started at: " + script_start.strftime("%Y-%m-%d %H:%M:%S"))
 
-    print("Identifying legacy digital object records in AtoM...")
-    flush_legacy_digital_file_properties(legacy_dip_files)
+    # Legacy objects are only extracted once per set of working tables. A
+    # resumed run picks up the AIPs that have not reached the last phase.
+    sql = "SELECT phase, COUNT(*) AS aip_count FROM aip_status WHERE TRUE" + working_shard_filter() + " GROUP BY phase;"
+    mysqlCursor.execute(sql)
+    phases = {row["phase"]: row["aip_count"] for row in mysqlCursor.fetchall()}
+    if phases:
+        print("Resuming from the existing working tables. AIPs per completed phase: " + ", ".join(phase + " " + str(count) for phase, count in sorted(phases.items())))
+    else:
+        print("Identifying legacy digital object records in AtoM...")
+        record_shard_status("extracting")
+        phase_start = time.monotonic()
+        flush_legacy_digital_file_properties()
+        time_phase("extraction", phase_start)
+        write_run_report(script_start)
+
+    if STORAGE_SERVICE_URL:
+        print("Looking up AIP locations in the Storage Service...")
+        lookup_packages()
 
     print("Parsing digital object properties from Archivematica METS files...")
     try:
-        # Select next unparsed legacy DIP file record from the working table.
-        sql = "SELECT * FROM dip_files WHERE parsed = %s;"
+        # Count the AIPs that contain unparsed legacy DIP file records.
+        sql = "SELECT COUNT(DISTINCT aip_uuid) AS aip_count, COUNT(*) AS file_count FROM dip_files WHERE parsed = %s" + working_shard_filter() + ";"
         mysqlCursor.execute(sql, False)
-        legacy_dip_file = mysqlCursor.fetchone()
+        unparsed = mysqlCursor.fetchone()
     except Exception as e:
         print(e)
         sys.exit("Unable to query the working table.")
-    while legacy_dip_file:
-        parse_mets_values(legacy_dip_file["aip_uuid"])
-        sql = "SELECT * FROM dip_files WHERE parsed = %s;"
-        mysqlCursor.execute(sql, False)
-        legacy_dip_file = mysqlCursor.fetchone()
+    parse_downloaded_aips(iter_unparsed_aips(), unparsed["aip_count"], unparsed["file_count"])
+    write_run_report(script_start)
 
-    print("Updating digital object properties in AtoM MySQL...")
+    if DRY_RUN:
+        print("Comparing digital object properties with AtoM MySQL...")
+    else:
+        print("Updating digital object properties in AtoM MySQL...")
+    phase_start = time.monotonic()
     update_digital_file_properties()
+    time_phase("write", phase_start)
+    record_shard_status("previewed" if DRY_RUN else "finished")
+    mysqlConnection.commit()
 
-    if DELETE_TEMP_FILES:
+    # A dry run keeps the working tables for the run that writes them.
+    if DELETE_TEMP_FILES and SHARD is None and not DRY_RUN:
         print("Cleaning up temporary files...")
         delete_temporary_files()
     else:
@@ -128,69 +683,132 @@ def main():
     duration = script_end - script_start
     print("Script duration: " + str(duration))
     print("Number of errors encountered: " + str(ERROR_COUNT))
+    write_run_report(script_start)
+    if RUN_REPORT:
+        print("Per-phase timings and counters written to " + RUN_REPORT)
+    if DRY_RUN:
+        print("Dry run: no properties were changed. Run again with --resume to write the differences listed in " + PROPERTY_DIFF_REPORT)
 
 
-def flush_legacy_digital_file_properties(legacy_dip_files):
+def flush_legacy_digital_file_properties():
+    '''
+    Copy the object and AIP UUID of every legacy digital object of this
+    host's shard into the working table. Legacy objects that cannot be
+    resolved are written to the UNRESOLVED_REPORT instead.
+    '''
     global ERROR_COUNT
 
-    for file in legacy_dip_files:
-        try:
-            # Select the Archivematica Object UUID which will be used to find
-            # property info in the METS file.
-            sql = "SELECT value FROM property_i18n WHERE id = %s;"
-            mysqlCursor.execute(sql, file['id'])
-            object_uuid = mysqlCursor.fetchone()
-        except Exception as e:
-            print("Unable to select Object UUID for object# " + str(file['id']) + ". Skipping...")
-            print(e)
-            ERROR_COUNT += 1
-            continue
+    # The legacy objects are read with a plain, non-locking SELECT on a
+    # separate connection and inserted in batches. An INSERT ... SELECT
+    # would take shared locks on every property and working table row it
+    # scans, which deadlocks hosts extracting or writing other shards.
+    shard = SHARD[0] if SHARD is not None else 0
+    stored_count = 0
+    aip_uuids = set()
+    try:
+        connection = connect_atom_database(pymysql.cursors.SSDictCursor)
+        cursor = connection.cursor()
+        # The Archivematica Object UUID is used to find property info in the
+        # METS file and the AIP UUID to fetch the METS file from the Storage
+        # Service. MIN() picks one value if an object has several. The shard
+        # is chosen by the AIP UUID picked, so that an object with several
+        # aipUUID properties still belongs to a single shard.
+        sql = """SELECT legacy.object_id, MIN(object_i18n.value) AS object_uuid, MIN(aip_i18n.value) AS aip_uuid
+            FROM property legacy
+            JOIN property_i18n object_i18n ON object_i18n.id = legacy.id
+            JOIN property aip ON aip.object_id = legacy.object_id AND aip.name = 'aipUUID'
+            JOIN property_i18n aip_i18n ON aip_i18n.id = aip.id
+            WHERE legacy.name = 'objectUUID' AND legacy.scope IS NULL
+            AND CHAR_LENGTH(object_i18n.value) = 36 AND CHAR_LENGTH(aip_i18n.value) = 36
+            GROUP BY legacy.object_id
+            HAVING TRUE""" + shard_filter("MIN(aip_i18n.value)") + ";"
+        cursor.execute(sql)
+        sql = "INSERT INTO dip_files (object_id, object_uuid, aip_uuid, parsed, shard) VALUES (%s, %s, %s, FALSE, %s);"
+        while True:
+            rows = cursor.fetchmany(PARSE_WRITE_BATCH_SIZE)
+            if not rows:
+                break
+            mysqlCursor.executemany(sql, [(row["object_id"], row["object_uuid"], row["aip_uuid"], shard) for row in rows])
+            aip_uuids.update(row["aip_uuid"] for row in rows)
+            stored_count += len(rows)
+        connection.close()
+        sql = "INSERT INTO aip_status (aip_uuid, shard) VALUES (%s, %s);"
+        mysqlCursor.executemany(sql, [(aip_uuid, shard) for aip_uuid in sorted(aip_uuids)])
+        mysqlConnection.commit()
+        count_phase("extraction", rows=stored_count)
+        print("Stored " + str(stored_count) + " legacy digital object records in the working table.")
+    except Exception as e:
+        print(e)
+        sys.exit("Unable to insert working data for the legacy digital objects.")
 
-        try:
-            # Select the Archivematica AIP UUID which will be used to fetch
-            # the METS file from the Storage Service.
-            sql = "SELECT id from property WHERE name = 'aipUUID' AND object_id = %s;"
-            mysqlCursor.execute(sql, file['object_id'])
-            property_id = mysqlCursor.fetchone()
-            sql = "SELECT value FROM property_i18n WHERE id = %s;"
-            mysqlCursor.execute(sql, property_id['id'])
-            aip_uuid = mysqlCursor.fetchone()
-        except Exception as e:
-            print("Unable to select AIP UUID for object# " + str(file['id']) + ". Skipping...")
-            print(e)
-            ERROR_COUNT += 1
-            continue
+    # Objects that cannot be resolved have no AIP to shard by, so they are
+    # reported by the first shard only.
+    if SHARD is not None and SHARD[0] != 0:
+        return
 
-        try:
-            # Store identifier values in the working table.
-            sql = "INSERT INTO dip_files (object_id, object_uuid, aip_uuid, parsed) VALUES (%s, %s, %s, %s);"
-            mysqlCursor.execute(sql, (file['object_id'], object_uuid['value'], aip_uuid['value'], False))
-            mysqlConnection.commit()
-        except Exception as e:
-            print("Unable to insert working data for object# " + str(file['id']) + ". Skipping...")
-            print(e)
-            ERROR_COUNT += 1
-            continue
+    try:
+        sql = """SELECT legacy.id, legacy.object_id, MIN(object_i18n.value) AS object_uuid, MIN(aip_i18n.value) AS aip_uuid
+            FROM property legacy
+            LEFT JOIN property_i18n object_i18n ON object_i18n.id = legacy.id
+            LEFT JOIN property aip ON aip.object_id = legacy.object_id AND aip.name = 'aipUUID'
+            LEFT JOIN property_i18n aip_i18n ON aip_i18n.id = aip.id
+            WHERE legacy.name = 'objectUUID' AND legacy.scope IS NULL
+            GROUP BY legacy.id, legacy.object_id
+            HAVING object_uuid IS NULL OR aip_uuid IS NULL
+            OR CHAR_LENGTH(object_uuid) <> 36 OR CHAR_LENGTH(aip_uuid) <> 36;"""
+        mysqlCursor.execute(sql)
+        unresolved = mysqlCursor.fetchall()
+    except Exception as e:
+        print("Unable to list the legacy digital objects that could not be resolved.")
+        print(e)
+        ERROR_COUNT += 1
+        return
+
+    if unresolved:
+        with open(UNRESOLVED_REPORT, "w", newline="") as report:
+            writer = csv.writer(report)
+            writer.writerow(["property_id", "object_id", "object_uuid", "aip_uuid", "reason"])
+            for row in unresolved:
+                if row["object_uuid"] is None:
+                    reason = "missing object UUID"
+                elif row["aip_uuid"] is None:
+                    reason = "missing AIP UUID"
+                else:
+                    reason = "malformed UUID"
+                writer.writerow([row["id"], row["object_id"], row["object_uuid"], row["aip_uuid"], reason])
+        count_phase("extraction", unresolved=len(unresolved))
+        print("Unable to resolve " + str(len(unresolved)) + " legacy digital objects. See " + UNRESOLVED_REPORT + " for details.")
+        ERROR_COUNT += len(unresolved)
     return
 
 
-def get_mets_path(aip_uuid):
+def get_package(aip_uuid):
+    def read_package(response):
+        if response.status_code >= 400:
+            # The URL holds the API key, so it is left out.
+            raise requests.HTTPError("Storage Service responded with " + str(response.status_code) + " " + response.reason)
+        return response.json()
+
     request_url = STORAGE_SERVICE_URL + "/file/" + aip_uuid + "?username=" + STORAGE_SERVICE_USER + "&api_key=" + STORAGE_SERVICE_API_KEY
-    try:
-        response = requests.get(request_url)
-    except Exception as e:
-        print(e)
-        sys.exit("Unable to connect to Storage Service. Check your connection parameters.")
+    return storage_service_request(request_url, "package", read_package)
 
-    package = response.json()
 
+def get_mets_path(aip_uuid):
+    # Any failure is raised to the download worker, which reports it and
+    # gives up on this AIP only.
+    package = get_package(aip_uuid)
+    relativePathToMETS, transfer_name = package_mets_path(package["uuid"], package["current_path"])
+    return relativePathToMETS, transfer_name, package["current_path"]
+
+
+def package_mets_path(aip_uuid, current_path):
     # build relative path to METS file
-    if package["current_path"].endswith(".7z"):
-        relativePath = package["current_path"][40:-3]
+    if current_path.endswith(".7z"):
+        relativePath = current_path[40:-3]
     else:
-        relativePath = package["current_path"][40:]
+        relativePath = current_path[40:]
     relativePathToMETS = (
-        relativePath + "/data/METS." + package["uuid"] + ".xml"
+        relativePath + "/data/METS." + aip_uuid + ".xml"
     )
 
     # Derive AIP transfer name from filepath value by removing UUID suffix
@@ -199,133 +817,733 @@ def get_mets_path(aip_uuid):
     return relativePathToMETS, transfer_name
 
 
-def get_mets_file(aip_uuid, relative_path):
+def lookup_package(aip_uuid):
+    # Runs in a lookup worker thread. Returns None if the AIP needs no
+    # lookup, or if the lookup failed, in which case the download worker
+    # tries again and reports the error.
+    if aip_uuid in local_mets_index:
+        return None
+    entry = cached_mets(aip_uuid)
+    if entry is not None and entry["current_path"]:
+        return {"aip_uuid": aip_uuid, "current_path": entry["current_path"], "location": None, "latency": None}
+    start = time.monotonic()
+    try:
+        package = get_package(aip_uuid)
+        return {"aip_uuid": aip_uuid, "current_path": package["current_path"], "location": package.get("current_location"), "latency": time.monotonic() - start}
+    except Exception:
+        return None
+
+
+def lookup_packages():
+    '''
+    Record the Storage Service location and path of every AIP that still
+    has METS files to fetch, so that downloads can be grouped by location
+    and package type. The package details are small, so looking them all up
+    first costs little next to fetching the METS files.
+    '''
+    sql = "SELECT aip_uuid FROM aip_status WHERE current_path IS NULL AND phase IN ('extracted', 'downloaded')" + working_shard_filter() + ";"
+    mysqlCursor.execute(sql)
+    aip_uuids = [row["aip_uuid"] for row in mysqlCursor.fetchall()]
+    if not aip_uuids:
+        return
+
+    load_mets_manifest()
+    stage_start = time.monotonic()
+    packages = []
+    lookup_count = 0
+    sql = "UPDATE aip_status SET current_path = %s, location = %s, compressed = %s WHERE aip_uuid = %s;"
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        for package in executor.map(lookup_package, aip_uuids):
+            lookup_count += 1
+            if LIVE_PROGRESS:
+                print_progress("Looked up AIPs", lookup_count, len(aip_uuids), stage_start)
+            if package is None:
+                continue
+            if package["latency"] is not None:
+                record_latency("path_lookup", package["latency"])
+            packages.append((package["current_path"], package["location"], package["current_path"].endswith(".7z"), package["aip_uuid"]))
+            if len(packages) >= PARSE_WRITE_BATCH_SIZE:
+                mysqlCursor.executemany(sql, packages)
+                mysqlConnection.commit()
+                packages = []
+    if packages:
+        mysqlCursor.executemany(sql, packages)
+        mysqlConnection.commit()
+
+    elapsed = time.monotonic() - stage_start
+    count_phase("path_lookup", workers=DOWNLOAD_WORKERS, seconds=elapsed, stage_seconds=elapsed)
+    print("Looked up " + str(lookup_count) + " AIPs in " + "{:.2f}".format(elapsed) + "s.")
+
+
+def get_mets_file(aip_uuid, relative_path, compressed=False):
+    '''
+    Download the METS file of an AIP into the cache. Returns the response
+    status, the request URL and the checksum of the METS file, or None if
+    it was not downloaded.
+    '''
+    def save_mets_file(response):
+        if response.status_code != 200:
+            return response.status_code, None
+        # The size can only be checked against the Content-Length when the
+        # body is sent as is.
+        expected_size = None
+        if "Content-Length" in response.headers and "Content-Encoding" not in response.headers:
+            expected_size = int(response.headers["Content-Length"])
+        size, checksum = write_mets_file(aip_uuid, response.iter_content(METS_DOWNLOAD_CHUNK_SIZE), expected_size)
+        return response.status_code, checksum
+
     request_url = STORAGE_SERVICE_URL + "/file/" + aip_uuid + "/extract_file/?relative_path_to_file=" + relative_path + "&username=" + STORAGE_SERVICE_USER + "&api_key=" + STORAGE_SERVICE_API_KEY
-    response = requests.get(request_url)
-    if response.status_code == 200:
-        mets_file = "METS.{}.xml".format(aip_uuid)
-        download_file = os.path.join(METS_DIR, mets_file)
-        with open(download_file, "wb") as file:
-            file.write(response.content)
-    return (response.status_code, request_url)
+    # Compressed AIPs are unpacked first, so their response times are
+    # compared with each other only.
+    kind = "compressed METS" if compressed else "METS"
+    status_code, checksum = storage_service_request(request_url, kind, save_mets_file)
+    return (status_code, request_url, checksum)
 
 
-def parse_mets_values(aip_uuid):
-    global ERROR_COUNT
+def mets_file_path(aip_uuid):
+    return os.path.join(METS_DIR, "METS.{}.xml".format(aip_uuid))
+
 
-    # Identify all AtoM digital objects in this Archivematica AIP.
+def write_mets_file(aip_uuid, chunks, expected_size=None):
+    '''
+    Write a METS file into the cache from an iterable of chunks, so only one
+    chunk is held in memory at a time. The file is written under a
+    temporary name and only renamed into place once it is complete, so an
+    interrupted write never leaves a partial METS file behind. Returns its
+    size and checksum, computed as the chunks are written.
+    '''
+    path = mets_file_path(aip_uuid)
+    temporary_path = path + ".part"
+    checksum = hashlib.sha256()
+    size = 0
     try:
-        sql = "SELECT * FROM dip_files WHERE aip_uuid = %s;"
-        mysqlCursor.execute(sql, aip_uuid)
-        legacy_dip_files = mysqlCursor.fetchall()
-    except Exception as e:
-        print("Unable to fetch the digital object records associated with AIP " + aip_uuid)
-        print(e)
+        with open(temporary_path, "wb") as file:
+            for chunk in chunks:
+                file.write(chunk)
+                checksum.update(chunk)
+                size += len(chunk)
+            file.flush()
+            os.fsync(file.fileno())
+        if expected_size is not None and size != expected_size:
+            # Raised as a broken transfer, so that the download is retried.
+            raise requests.exceptions.ChunkedEncodingError("Received " + str(size) + " of " + str(expected_size) + " bytes of the METS file for package " + aip_uuid)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return size, checksum.hexdigest()
+
+
+def file_checksum(path):
+    checksum = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1048576), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
 
+def append_mets_manifest(entry):
+    # Must be called while holding mets_manifest_lock.
+    with open(METS_MANIFEST, "a") as manifest_file:
+        manifest_file.write(json.dumps(entry) + "\n")
+
+
+def load_mets_manifest():
+    '''
+    Read the METS cache manifest. Later lines override earlier ones, and
+    the file is compacted when most of its lines are stale.
+    '''
+    global mets_cache_size
+
+    mets_manifest.clear()
+    mets_cache_heap.clear()
+    mets_cache_deferred.clear()
+    mets_cache_size = 0
+    if not os.path.exists(METS_MANIFEST):
+        return
+    line_count = 0
+    with open(METS_MANIFEST) as manifest_file:
+        for line in manifest_file:
+            line_count += 1
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A partial line left behind by an interrupted run.
+                continue
+            if entry.get("evicted"):
+                mets_manifest.pop(entry["aip_uuid"], None)
+            else:
+                mets_manifest[entry["aip_uuid"]] = entry
+    mets_cache_size = sum(entry["size"] for entry in mets_manifest.values())
+    mets_cache_heap.extend((entry["last_used"], entry["aip_uuid"]) for entry in mets_manifest.values())
+    heapq.heapify(mets_cache_heap)
+    if line_count > 2 * len(mets_manifest) + 100:
+        write_mets_manifest()
+
+
+def write_mets_manifest():
+    # Rewrite the manifest with one line per cached METS file.
+    with mets_manifest_lock:
+        with open(METS_MANIFEST + ".tmp", "w") as manifest_file:
+            for entry in mets_manifest.values():
+                manifest_file.write(json.dumps(entry) + "\n")
+        os.replace(METS_MANIFEST + ".tmp", METS_MANIFEST)
+
+
+def cached_mets(aip_uuid):
+    '''
+    Return the manifest entry of a usable cached METS file, or None.
+    '''
+    with mets_manifest_lock:
+        entry = mets_manifest.get(aip_uuid)
+    if entry is None:
+        return None
+    path = mets_file_path(aip_uuid)
+    if not os.path.exists(path) or os.path.getsize(path) != entry["size"]:
+        return None
+    if VERIFY_METS_CACHE and file_checksum(path) != entry["checksum"]:
+        return None
+    # Kept in memory only. The manifest is rewritten once per run if
+    # eviction needs it.
+    with mets_manifest_lock:
+        entry["last_used"] = time.time()
+        heapq.heappush(mets_cache_heap, (entry["last_used"], aip_uuid))
+    return entry
+
+
+def record_cached_mets(aip_uuid, current_path, aip_name, checksum=None):
+    # The checksum is only computed here if it was not taken while the METS
+    # file was written.
+    path = mets_file_path(aip_uuid)
+    entry = {
+        "aip_uuid": aip_uuid,
+        "size": os.path.getsize(path),
+        "checksum": checksum or file_checksum(path),
+        "current_path": current_path,
+        "aipName": aip_name,
+        "last_used": time.time(),
+    }
+    global mets_cache_size
+
+    with mets_manifest_lock:
+        previous = mets_manifest.get(aip_uuid)
+        mets_cache_size += entry["size"] - (previous["size"] if previous else 0)
+        mets_manifest[aip_uuid] = entry
+        heapq.heappush(mets_cache_heap, (entry["last_used"], aip_uuid))
+        append_mets_manifest(entry)
+    return entry
+
+
+def evict_mets_cache(pending_aips):
+    '''
+    Delete least recently used METS files until the cache fits within
+    METS_CACHE_MAX_BYTES. Any cached METS file can be deleted, including
+    those of earlier runs, except the METS files of `pending_aips`, which
+    are still waiting to be downloaded or parsed.
+    '''
+    global mets_cache_size
+
+    if METS_CACHE_MAX_BYTES is None:
         return
+    with mets_manifest_lock:
+        while mets_cache_size > METS_CACHE_MAX_BYTES and mets_cache_heap:
+            last_used, aip_uuid = heapq.heappop(mets_cache_heap)
+            entry = mets_manifest.get(aip_uuid)
+            if entry is None or entry["last_used"] != last_used:
+                continue
+            if aip_uuid in pending_aips:
+                mets_cache_deferred[aip_uuid] = last_used
+                continue
+            for path in (mets_file_path(aip_uuid), mets_index_path(mets_file_path(aip_uuid))):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            mets_cache_size -= entry["size"]
+            del mets_manifest[aip_uuid]
+            append_mets_manifest({"aip_uuid": aip_uuid, "evicted": True})
+
 
-    # Download METS file if a local copy is not present.
-    if os.path.exists(METS_DIR + aip_uuid + ".xml") is False:
+def release_pending_aip(aip_uuid, pending_aips):
+    # The AIP's METS file can be evicted from now on.
+    with mets_manifest_lock:
+        pending_aips.discard(aip_uuid)
+        last_used = mets_cache_deferred.pop(aip_uuid, None)
+        if last_used is not None:
+            heapq.heappush(mets_cache_heap, (last_used, aip_uuid))
+
+
+def pending_aip_uuids():
+    # The AIPs whose METS files the parse stage still needs.
+    sql = "SELECT DISTINCT aip_uuid FROM dip_files WHERE parsed = FALSE" + working_shard_filter() + ";"
+    mysqlCursor.execute(sql)
+    return {row["aip_uuid"] for row in mysqlCursor.fetchall()}
+
+
+def read_local_manifest(directory):
+    # AIP names from the manifest of a METS_DIR staged from another host.
+    aip_names = {}
+    manifest_path = os.path.join(directory, os.path.basename(METS_MANIFEST))
+    if not os.path.isfile(manifest_path):
+        return aip_names
+    with open(manifest_path) as manifest_file:
+        for line in manifest_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("aipName"):
+                aip_names[entry["aip_uuid"]] = entry["aipName"]
+    return aip_names
+
+
+def index_local_mets_source():
+    '''
+    Find the pre-staged METS files below LOCAL_METS_SOURCE. Package
+    directories are not descended into beyond their METS file, so a mounted
+    AIP store is indexed without walking the contents of every AIP. Returns
+    the number of compressed AIPs found, which are left to the Storage
+    Service.
+    '''
+    local_mets_index.clear()
+    compressed_count = 0
+    for directory, subdirectories, files in os.walk(LOCAL_METS_SOURCE):
+        match = AIP_DIRECTORY.match(os.path.basename(directory))
+        if match is not None:
+            subdirectories[:] = []
+            aip_name, aip_uuid = match.groups()
+            path = os.path.join(directory, "data", "METS." + aip_uuid + ".xml")
+            if os.path.isfile(path):
+                local_mets_index[aip_uuid] = (path, aip_name)
+            continue
+
+        aip_names = None
+        for name in files:
+            match = METS_FILE_NAME.match(name)
+            if match is not None:
+                if aip_names is None:
+                    aip_names = read_local_manifest(directory)
+                aip_uuid = match.group(1)
+                local_mets_index.setdefault(aip_uuid, (os.path.join(directory, name), aip_names.get(aip_uuid)))
+            elif name.endswith(".7z") and AIP_DIRECTORY.match(name[:-3]):
+                compressed_count += 1
+    return compressed_count
+
+
+def mets_aip_name(mets_path, aip_uuid):
+    '''
+    Return the AIP name of a METS file from the label of its top directory
+    in the structMap, "<AIP name>-<AIP UUID>", or None if it has none.
+    '''
+    for event, element in etree.iterparse(mets_path, events=("start", "end")):
+        if event == "start":
+            label = element.get("LABEL", "")
+            if element.tag == METS_NS + "div" and element.get("TYPE") == "Directory" and label.endswith("-" + aip_uuid):
+                return label[:-len(aip_uuid) - 1]
+        elif element.tag in (METS_NS + "dmdSec", METS_NS + "amdSec", METS_NS + "fileSec"):
+            # Sections before the structMap are not needed.
+            element.clear()
+    return None
+
+
+def download_mets(aip_uuid, current_path=None):
+    '''
+    Fetch the METS file for one AIP. This runs in a download worker thread,
+    so it must not touch the MySQL connection. Failures are returned to the
+    caller rather than handled here. The package's `current_path` is looked
+    up in the Storage Service unless it is given.
+    '''
+    download = {"aip_uuid": aip_uuid, "transfer_name": None, "bytes": 0, "lookup_latency": None, "latency": None, "cached": False, "local": False, "compressed": False, "checksum": None, "error": None, "exception": None}
+
+    # Skip the Storage Service entirely if the METS file is already cached.
+    entry = cached_mets(aip_uuid)
+    if entry is not None:
+        download["transfer_name"] = entry["aipName"]
+        download["checksum"] = entry["checksum"]
+        download["cached"] = True
+        return download
+
+    # Pre-staged METS files are copied into the cache instead.
+    if aip_uuid in local_mets_index:
+        local_path, download["transfer_name"] = local_mets_index[aip_uuid]
         try:
-            path, transfer_name = get_mets_path(aip_uuid)
+            with open(local_path, "rb") as local_file:
+                size, checksum = write_mets_file(aip_uuid, iter(lambda: local_file.read(METS_DOWNLOAD_CHUNK_SIZE), b""))
         except Exception as e:
-            print("Unable to derive relative path of METS file in package " + aip_uuid)
-            print(e)
-            ERROR_COUNT += 1
-            # Give up trying to update files from this AIP
-            for file in legacy_dip_files:
-                sql = "DELETE FROM dip_files WHERE object_id = %s;"
-                mysqlCursor.execute(sql, file['object_id'])
-                mysqlConnection.commit()
-            return
+            download["error"] = "Unable to copy pre-staged METS file " + local_path
+            download["exception"] = e
+            return download
+        # METS files staged without a manifest carry the AIP name inside.
+        if download["transfer_name"] is None:
+            try:
+                download["transfer_name"] = mets_aip_name(mets_file_path(aip_uuid), aip_uuid)
+            except etree.XMLSyntaxError:
+                pass
+        download["local"] = True
+        download["checksum"] = record_cached_mets(aip_uuid, None, download["transfer_name"], checksum)["checksum"]
+        return download
+    if not STORAGE_SERVICE_URL:
+        download["error"] = "Unable to find a pre-staged METS file for package " + aip_uuid + " in " + str(LOCAL_METS_SOURCE)
+        return download
+
+    if current_path is not None:
+        path, download["transfer_name"] = package_mets_path(aip_uuid, current_path)
+    else:
+        start = time.monotonic()
+        try:
+            path, download["transfer_name"], current_path = get_mets_path(aip_uuid)
+        except Exception as e:
+            download["error"] = "Unable to derive relative path of METS file in package " + aip_uuid
+            download["exception"] = e
+            return download
+        finally:
+            download["lookup_latency"] = time.monotonic() - start
+    download["compressed"] = current_path.endswith(".7z")
+
+    # A METS file left behind by an earlier run without a manifest entry
+    # only needs the package details, not a second download.
+    checksum = None
+    if not os.path.exists(mets_file_path(aip_uuid)):
+        # Only COMPRESSED_DOWNLOAD_WORKERS fetch from compressed AIPs at once.
+        limit = compressed_downloads if download["compressed"] else contextlib.nullcontext()
         try:
-            mets_file_status, request_url = get_mets_file(aip_uuid, path)
+            with limit:
+                start = time.monotonic()
+                mets_file_status, request_url, checksum = get_mets_file(aip_uuid, path, download["compressed"])
+                download["latency"] = time.monotonic() - start
             if mets_file_status != 200:
-                print("Unable to fetch METS file for package " + aip_uuid)
-                ERROR_COUNT += 1
-                # Give up trying to update files from this AIP
-                for file in legacy_dip_files:
-                    sql = "DELETE FROM dip_files WHERE object_id = %s;"
-                    mysqlCursor.execute(sql, file['object_id'])
-                    mysqlConnection.commit()
-                return
+                download["error"] = "Unable to fetch METS file for package " + aip_uuid
+                return download
         except Exception as e:
-            print("Unable to fetch METS file for package " + aip_uuid)
-            print(e)
-            ERROR_COUNT += 1
-            # Give up trying to update files from this AIP
-            for file in legacy_dip_files:
-                sql = "DELETE FROM dip_files WHERE object_id = %s;"
-                mysqlCursor.execute(sql, file['object_id'])
-                mysqlConnection.commit()
-            return
+            download["error"] = "Unable to fetch METS file for package " + aip_uuid
+            download["exception"] = e
+            return download
+        download["bytes"] = os.path.getsize(mets_file_path(aip_uuid))
 
-    # Read the METS file.
+    download["checksum"] = record_cached_mets(aip_uuid, current_path, download["transfer_name"], checksum)["checksum"]
+    return download
+
+
+def iter_unparsed_aips():
+    '''
+    Stream the unparsed working table records in a single pass, grouped by
+    AIP. A server-side cursor on a separate connection keeps the result set
+    out of memory while the main connection updates the working table. AIPs
+    are ordered by Storage Service location, then uncompressed before
+    compressed packages.
+    '''
     try:
-        mets = metsrw.METSDocument.fromfile(METS_DIR + "METS." + aip_uuid + ".xml")
+        connection = connect_atom_database(pymysql.cursors.SSDictCursor)
+        cursor = connection.cursor()
+        # The stream is read at the pace of the parser, which can stall on
+        # a large METS file for longer than the server's default timeout.
+        cursor.execute("SET SESSION net_write_timeout = 86400;")
+        sql = "SELECT dip_files.object_id, dip_files.object_uuid, dip_files.aip_uuid, aip_status.current_path FROM dip_files JOIN aip_status ON aip_status.aip_uuid = dip_files.aip_uuid WHERE dip_files.parsed = %s" + working_shard_filter("dip_files.shard") + " ORDER BY aip_status.location, aip_status.compressed, dip_files.aip_uuid;"
+        cursor.execute(sql, False)
     except Exception as e:
-        print("METSRW is unable to parse the METS XML for package " + aip_uuid + ". Check your markup and see archivematica/issues#1129.")
         print(e)
-        ERROR_COUNT += 1
-        # Give up trying to update files from this AIP
-        for file in legacy_dip_files:
-            sql = "UPDATE dip_files SET parsed = %s WHERE object_id = %s;"
-            mysqlCursor.execute(sql, True, file['object_id'])
-            mysqlConnection.commit()
-        return
+        sys.exit("Unable to query the working table.")
+    try:
+        for aip_uuid, legacy_dip_files in itertools.groupby(cursor, key=lambda row: row["aip_uuid"]):
+            yield aip_uuid, list(legacy_dip_files)
+    finally:
+        connection.close()
 
-    for file in legacy_dip_files:
+
+def start_parse_pool():
+    # Parser processes are started fresh instead of being forked from this
+    # process, which is also running the download threads by then.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+    else:
+        context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=context)
+
+
+def mets_index_path(mets_path):
+    return mets_path[:-len(".xml")] + ".index.json"
+
+
+def read_mets_index(mets_path, checksum):
+    # Return the records of a METS index that matches the METS file, or None.
+    try:
+        with open(mets_index_path(mets_path)) as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
+        return None
+    if index.get("version") != METS_INDEX_VERSION or index.get("checksum") != checksum:
+        return None
+    return index["records"]
+
+
+def write_mets_index(mets_path, checksum, records):
+    # Dates are stored as the strings MySQL would have written for them.
+    index = {"version": METS_INDEX_VERSION, "checksum": checksum, "records": records}
+    temporary_path = mets_index_path(mets_path) + ".part"
+    with open(temporary_path, "w") as index_file:
+        json.dump(index, index_file, default=str)
+    os.replace(temporary_path, mets_index_path(mets_path))
+
+
+def parse_aip_mets(mets_path, object_uuids, checksum=None):
+    '''
+    Parse the local METS file of one AIP. This runs in a METS parser
+    process, so it only returns plain records and never touches MySQL.
+    Returns the records or the error, and the time spent parsing.
+
+    Given the checksum of the METS file, the records of every file in the
+    AIP are read from, or written to, its METS index.
+    '''
+    start = time.monotonic()
+    try:
+        if checksum is None:
+            return extract_mets_records(mets_path, object_uuids), None, time.monotonic() - start
+        records = read_mets_index(mets_path, checksum)
+        if records is None:
+            records = extract_mets_records(mets_path, None)
+            try:
+                write_mets_index(mets_path, checksum, records)
+            except Exception as e:
+                print("Unable to write the METS index for " + mets_path)
+                print(e)
+        records = {object_uuid: records[object_uuid] for object_uuid in object_uuids if object_uuid in records}
+        return records, None, time.monotonic() - start
+    except Exception as e:
+        return None, str(e), time.monotonic() - start
+
+
+def parse_downloaded_aips(unparsed_aips, aip_count, file_count):
+    '''
+    Parse METS files in a pool of PARSE_WORKERS processes while a pool of
+    download workers fetches the METS files of the AIPs queued behind them.
+    Parsed records are written to the working table in batches.
+    '''
+    global compressed_downloads
+
+    parsed_aips = set()
+    parsed_values = []
+    parsed_events = []
+    aip_phases = []
+    parsed_file_count = 0
+    cached_count = 0
+    local_count = 0
+    downloaded_count = 0
+    downloaded_bytes = 0
+    latencies = []
+    stage_start = time.monotonic()
+    count_phase("download", workers=DOWNLOAD_WORKERS)
+    count_phase("parse", workers=PARSE_WORKERS)
+
+    load_mets_manifest()
+    compressed_downloads = threading.BoundedSemaphore(COMPRESSED_DOWNLOAD_WORKERS)
+    # Trim the METS files left by earlier runs before adding new ones.
+    pending_aips = pending_aip_uuids() if METS_CACHE_MAX_BYTES is not None else set()
+    evict_mets_cache(pending_aips)
+
+    with start_parse_pool() as parse_pool, ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        downloads = deque()
+        for aip_uuid, legacy_dip_files in unparsed_aips:
+            downloads.append((legacy_dip_files, executor.submit(download_mets, aip_uuid, legacy_dip_files[0]["current_path"])))
+            if len(downloads) >= DOWNLOAD_PREFETCH:
+                break
+
+        parses = deque()
+        while downloads or parses:
+            # Hand downloaded METS files to the parser processes until each
+            # of them has work queued.
+            if downloads and len(parses) < PARSE_WORKERS * 2:
+                legacy_dip_files, future = downloads.popleft()
+                download = future.result()
+                # Keep the download queue topped up.
+                next_aip = next(unparsed_aips, None)
+                if next_aip is not None:
+                    downloads.append((next_aip[1], executor.submit(download_mets, next_aip[0], next_aip[1][0]["current_path"])))
+
+                if download["cached"]:
+                    cached_count += 1
+                    count_phase("download", cached=1)
+                if download["local"]:
+                    local_count += 1
+                    count_phase("download", local=1)
+                if download["compressed"]:
+                    count_phase("download", compressed=1)
+                if download["lookup_latency"] is not None:
+                    record_latency("path_lookup", download["lookup_latency"])
+                if download["latency"] is not None:
+                    record_latency("download", download["latency"])
+                    count_phase("download", bytes=download["bytes"])
+                if download["bytes"]:
+                    downloaded_count += 1
+                    downloaded_bytes += download["bytes"]
+                    latencies.append(download["latency"])
+                    if not LIVE_PROGRESS:
+                        print("Downloaded METS file for package " + download["aip_uuid"] + ": " + str(download["bytes"]) + " bytes in " + "{:.2f}".format(download["latency"]) + "s")
+
+                if download["error"]:
+                    parse_mets_values(download["aip_uuid"], legacy_dip_files, download, None, None)
+                    release_pending_aip(download["aip_uuid"], pending_aips)
+                    continue
+                aip_phases.append(("downloaded", download["aip_uuid"]))
+                object_uuids = [file["object_uuid"] for file in legacy_dip_files]
+                parses.append((legacy_dip_files, download, parse_pool.submit(parse_aip_mets, mets_file_path(download["aip_uuid"]), object_uuids, download["checksum"])))
+                continue
+
+            legacy_dip_files, download, future = parses.popleft()
+            records, parse_error, parse_seconds = future.result()
+            record_latency("parse", parse_seconds)
+            count_phase("parse", files=len(legacy_dip_files))
+            values, events = parse_mets_values(download["aip_uuid"], legacy_dip_files, download, records, parse_error)
+            parsed_values.extend(values)
+            parsed_events.extend(events)
+            count_phase("parse", events=sum(event_count for object_id, event_count, compressed_events in events))
+            if parse_error is None:
+                aip_phases.append(("parsed", download["aip_uuid"]))
+            if len(parsed_values) >= PARSE_WRITE_BATCH_SIZE:
+                write_start = time.monotonic()
+                write_parsed_values(parsed_values, parsed_events, aip_phases)
+                time_phase("parse_write", write_start)
+                count_phase("parse_write", rows=len(parsed_values) + len(parsed_events))
+                parsed_values = []
+                parsed_events = []
+                aip_phases = []
+
+            parsed_aips.add(download["aip_uuid"])
+            parsed_file_count += len(legacy_dip_files)
+            if LIVE_PROGRESS:
+                print_progress("Parsed digital objects", parsed_file_count, file_count, stage_start)
+            else:
+                print("Parsed AIP " + str(len(parsed_aips)) + " of " + str(aip_count) + " (" + str(parsed_file_count) + " of " + str(file_count) + " digital objects).")
+            release_pending_aip(download["aip_uuid"], pending_aips)
+            evict_mets_cache(pending_aips)
+
+    write_start = time.monotonic()
+    write_parsed_values(parsed_values, parsed_events, aip_phases)
+    time_phase("parse_write", write_start)
+    count_phase("parse_write", rows=len(parsed_values) + len(parsed_events))
+    # Record which cached METS files this run used, so that later runs
+    # evict the least recently used ones first.
+    if METS_CACHE_MAX_BYTES is not None and cached_count:
+        write_mets_manifest()
+    if LIVE_PROGRESS and parsed_file_count < file_count:
+        # AIPs that failed to download never reach the total.
+        print()
+
+    elapsed = time.monotonic() - stage_start
+    # The download and parse pools run alongside each other, so their busy
+    # time is compared with the wall clock time of the whole stage.
+    count_phase("download_and_parse", seconds=elapsed, aips=len(parsed_aips), files=parsed_file_count)
+    for phase in ("download", "parse"):
+        count_phase(phase, stage_seconds=elapsed)
+    if cached_count:
+        print("Re-used " + str(cached_count) + " cached METS files from " + METS_DIR)
+    if local_count:
+        print("Copied " + str(local_count) + " pre-staged METS files from " + LOCAL_METS_SOURCE)
+    if downloaded_count:
+        print("Downloaded " + str(downloaded_count) + " METS files (" + str(downloaded_bytes) + " bytes) in " + "{:.2f}".format(elapsed) + "s.")
+        print("Download throughput: " + "{:.2f}".format(downloaded_count / elapsed) + " AIPs/s, " + "{:.2f}".format(downloaded_bytes / elapsed / 1048576) + " MB/s")
+        print("Download latency per AIP: mean " + "{:.2f}".format(sum(latencies) / len(latencies)) + "s, max " + "{:.2f}".format(max(latencies)) + "s")
+
+
+def new_mets_record():
+    # Initialize all properties to Null to avoid missing value errors.
+    return {
+        "originalFileIngestedAt": None,
+        "relativePathWithinAip": None,
+        "originalFileName": None,
+        "originalFileSize": None,
+        "formatName": None,
+        "formatVersion": None,
+        "formatRegistryKey": None,
+        "preservationCopyNormalizedAt": None,
+        "preservationCopyFileName": None,
+        "preservationCopyFileSize": None,
+        "premisEvents": [],
+        "errors": [],
+    }
+
+
+def parse_event_date(event_date_time):
+    return datetime.strptime(event_date_time[0:19], "%Y-%m-%dT%H:%M:%S")
+
+
+def new_premis_event(event_type, event_date_time, outcome, outcome_detail_note, linking_agents):
+    return {
+        "type": event_type,
+        "dateTime": event_date_time,
+        "outcome": outcome,
+        "outcomeDetailNote": outcome_detail_note,
+        "linkingAgentIdentifier": [{"type": agent_type, "value": agent_value} for agent_type, agent_value in linking_agents],
+    }
+
+
+def metsrw_value(value):
+    # METSRW returns a tuple of empty elements instead of a missing value.
+    return value if isinstance(value, str) else None
+
+
+def metsrw_premis_event(premis_event):
+    linking_agents = [(metsrw_value(agent.linking_agent_identifier_type), metsrw_value(agent.linking_agent_identifier_value)) for agent in premis_event.linking_agent_identifier]
+    return new_premis_event(
+        metsrw_value(premis_event.event_type),
+        metsrw_value(premis_event.event_date_time),
+        metsrw_value(premis_event.event_outcome_information__event_outcome),
+        metsrw_value(premis_event.event_outcome_information__event_outcome_detail__event_outcome_detail_note),
+        linking_agents,
+    )
+
+
+def extract_mets_records_metsrw(mets_path, object_uuids):
+    '''
+    Read the values of each object in `object_uuids`, or of every file if
+    it is None, from a METS file with METSRW. Returns a dict of records
+    keyed by object UUID.
+    '''
+    mets = metsrw.METSDocument.fromfile(mets_path)
+    records = {}
+
+    # METSRW walks the whole document on every get_file() call, so index
+    # its files by UUID once.
+    fsentries = {}
+    for fsentry in mets.all_files():
+        if fsentry.file_uuid is not None:
+            fsentries.setdefault(fsentry.file_uuid, fsentry)
+    if object_uuids is None:
+        object_uuids = list(fsentries)
+
+    for object_uuid in object_uuids:
         # Retrieve values for the current AtoM digital object from the METS.
-        try:
-            fsentry = mets.get_file(file_uuid=file['object_uuid'])
-        except Exception as e:
-            print("Unable to find metadata for file " + file['object_uuid'] + " in METS." + aip_uuid + ".xml")
-            print(e)
-            ERROR_COUNT += 1
-            return
-
-        # Initialize all properties to Null to avoid missing value errors.
-        originalFileIngestedAt = None
-        relativePathWithinAip = None
-        aipName = None
-        originalFileName = None
-        originalFileSize = None
-        formatName = None
-        formatVersion = None
-        formatRegistryKey = None
-        preservationCopyNormalizedAt = None
-        preservationCopyFileName = None
-        preservationCopyFileSize = None
-        relativePathWithinAip = fsentry.path
-        aipName = transfer_name
-        originalFileName = fsentry.label
+        fsentry = fsentries.get(object_uuid)
+        if fsentry is None:
+            continue
+        record = new_mets_record()
+        record["relativePathWithinAip"] = fsentry.path
+        record["originalFileName"] = fsentry.label
 
         for premis_event in fsentry.get_premis_events():
             if (premis_event.event_type) == "ingestion":
-                eventDate = premis_event.event_date_time[0:19]
-                originalFileIngestedAt = datetime.strptime(eventDate, "%Y-%m-%dT%H:%M:%S")
-            '''
-            TODO: Add all PREMIS Events to AtoM MySQL database as a string array stored in a property_i18n text field. This is currently being done for AtoM 2.7 DIP uploads, even though these values do not appear anywhere in the AtoM GUI.
-            '''
+                record["originalFileIngestedAt"] = parse_event_date(premis_event.event_date_time)
+            try:
+                record["premisEvents"].append(metsrw_premis_event(premis_event))
+            except Exception as e:
+                record["errors"].append(("Unable to read a PREMIS event of file " + object_uuid + ".", str(e)))
 
         for premis_object in fsentry.get_premis_objects():
             try:
-                originalFileSize = premis_object.size
-                formatName = premis_object.format_name
+                record["originalFileSize"] = premis_object.size
+                record["formatName"] = premis_object.format_name
                 if (str(premis_object.format_registry_key)) != "(('format_registry_key',),)":
                     if (str(premis_object.format_registry_key)) != "()":
-                        formatRegistryKey = premis_object.format_registry_key
+                        record["formatRegistryKey"] = premis_object.format_registry_key
                 if (str(premis_object.format_version)) != "(('format_version',),)":
                     if (str(premis_object.format_version)) != "()":
-                        formatVersion = premis_object.format_version
+                        record["formatVersion"] = premis_object.format_version
             except Exception as e:
                 # A workaround hack for some METSRW failures that were only
                 # occurring on ISO formats in the sample data.
-                formatName = "ISO Disk Image File"
-                formatRegistryKey = "fmt/468"
-                print(e)
-                print("Unable to match file format to a registry key for digital object " + file['object_uuid'] + ". Using `fmt/468 - ISO Disk Image` as best guess.")
-                ERROR_COUNT += 1
+                record["formatName"] = "ISO Disk Image File"
+                record["formatRegistryKey"] = "fmt/468"
+                record["errors"].append((str(e), "Unable to match file format to a registry key for digital object " + object_uuid + ". Using `fmt/468 - ISO Disk Image` as best guess."))
                 continue
 
             # If this digital object has a preservation copy, retrieve its
@@ -336,79 +1554,549 @@ def parse_mets_values(aip_uuid):
                         preservation_copy_uuid = premis_object.relationship__related_object_identification__related_object_identifier_value
                     except AttributeError:
                         preservation_copy_uuid = premis_object.relationship__related_object_identifier__related_object_identifier_value
-                    preservation_file = mets.get_file(file_uuid=preservation_copy_uuid)
+                    preservation_file = fsentries.get(preservation_copy_uuid)
                     if preservation_file is not None:
-                        preservationCopyFileName = preservation_file.label
+                        record["preservationCopyFileName"] = preservation_file.label
                         for entry in preservation_file.get_premis_objects():
-                            preservationCopyFileSize = entry.size
+                            record["preservationCopyFileSize"] = entry.size
                         for event in preservation_file.get_premis_events():
                             if (event.event_type) == "creation":
-                                eventDate = event.event_date_time[0:19]
-                                preservationCopyNormalizedAt = datetime.strptime(eventDate, "%Y-%m-%dT%H:%M:%S")
+                                record["preservationCopyNormalizedAt"] = parse_event_date(event.event_date_time)
             except Exception as e:
-                print("Unable to add preservation copy information for file " + file['object_uuid'] + ".")
-                print(e)
-                ERROR_COUNT += 1
-                preservationCopyNormalizedAt = None
-                preservationCopyFileName = None
-                preservationCopyFileSize = None
+                record["errors"].append(("Unable to add preservation copy information for file " + object_uuid + ".", str(e)))
+                record["preservationCopyNormalizedAt"] = None
+                record["preservationCopyFileName"] = None
+                record["preservationCopyFileSize"] = None
                 continue
 
-            # Write the METS values to the MySQL working table.
-            sql = "UPDATE dip_files SET originalFileIngestedAt = %s, relativePathWithinAip = %s, aipName = %s, originalFileName = %s, originalFileSize = %s, formatName = %s, formatVersion = %s, formatRegistryName = %s, formatRegistryKey = %s, preservationCopyNormalizedAt = %s, preservationCopyFileName = %s, preservationCopyFileSize = %s, parsed = %s WHERE object_uuid = %s;"
-            mysqlCursor.execute(sql, (originalFileIngestedAt, relativePathWithinAip, aipName, originalFileName, originalFileSize, formatName, formatVersion, "PRONOM", formatRegistryKey, preservationCopyNormalizedAt, preservationCopyFileName, preservationCopyFileSize, True, file['object_uuid']))
-            mysqlConnection.commit()
+        records[object_uuid] = record
+
+    return records
+
+
+def premis_text(element, *path):
+    '''
+    Return the text of the first descendant of `element` along `path`,
+    matching local names only so PREMIS 2 and PREMIS 3 both work.
+    '''
+    for name in path:
+        for child in element:
+            if isinstance(child.tag, str) and etree.QName(child).localname == name:
+                element = child
+                break
+        else:
+            return None
+    return element.text or None
+
 
+def read_premis_amdsec(amdsec):
+    # Keep only the PREMIS object and event fields used by dip_files and
+    # the PREMIS event properties.
+    premis_objects = []
+    premis_events = []
+    for subsection in amdsec:
+        md_wrap = subsection.find(METS_NS + "mdWrap")
+        if md_wrap is None:
+            continue
+        xml_data = md_wrap.find(METS_NS + "xmlData")
+        if xml_data is None or not len(xml_data):
+            continue
+        premis = xml_data[0]
+        if md_wrap.get("MDTYPE") == "PREMIS:OBJECT":
+            related_object_uuid = premis_text(premis, "relationship", "relatedObjectIdentifier", "relatedObjectIdentifierValue")
+            if related_object_uuid is None:
+                related_object_uuid = premis_text(premis, "relationship", "relatedObjectIdentification", "relatedObjectIdentifierValue")
+            premis_objects.append({
+                "size": premis_text(premis, "objectCharacteristics", "size"),
+                "formatName": premis_text(premis, "objectCharacteristics", "format", "formatDesignation", "formatName"),
+                "formatVersion": premis_text(premis, "objectCharacteristics", "format", "formatDesignation", "formatVersion"),
+                "formatRegistryKey": premis_text(premis, "objectCharacteristics", "format", "formatRegistry", "formatRegistryKey"),
+                "relationshipSubType": premis_text(premis, "relationship", "relationshipSubType"),
+                "relatedObjectUUID": related_object_uuid,
+            })
+        elif md_wrap.get("MDTYPE") == "PREMIS:EVENT":
+            linking_agents = []
+            for child in premis:
+                if isinstance(child.tag, str) and etree.QName(child).localname == "linkingAgentIdentifier":
+                    linking_agents.append((premis_text(child, "linkingAgentIdentifierType"), premis_text(child, "linkingAgentIdentifierValue")))
+            premis_events.append(new_premis_event(
+                premis_text(premis, "eventType"),
+                premis_text(premis, "eventDateTime"),
+                premis_text(premis, "eventOutcomeInformation", "eventOutcome"),
+                premis_text(premis, "eventOutcomeInformation", "eventOutcomeDetail", "eventOutcomeDetailNote"),
+                linking_agents,
+            ))
+    return premis_objects, premis_events
+
+
+def extract_mets_records_iterparse(mets_path, object_uuids):
+    '''
+    Read the values of each object in `object_uuids`, or of every file if
+    it is None, from a METS file in a single streaming pass. Elements are
+    released as soon as their fields have been read, so memory use follows
+    the number of files in the AIP rather than the size of the METS
+    document. Returns the same records as extract_mets_records_metsrw(),
+    which benchmarks/compare_parsers.py checks.
+    '''
+    amdsecs = {}
+    files = {}
+    labels = {}
+    tags = (METS_NS + "amdSec", METS_NS + "file", METS_NS + "structMap")
+    for event, element in etree.iterparse(mets_path, events=("end",), tag=tags, huge_tree=True):
+        if element.tag == METS_NS + "amdSec":
+            amdsecs[element.get("ID")] = read_premis_amdsec(element)
+        elif element.tag == METS_NS + "file":
+            admids = (element.get("ADMID") or "").split()
+            flocat = element.find(METS_NS + "FLocat")
+            path = flocat.get(XLINK_NS + "href") if flocat is not None else None
+            files[element.get("ID")] = (admids[0] if admids else None, unquote_plus(path) if path else path)
+        elif element.get("TYPE") == "physical":
+            # Like METSRW, take labels from the physical structMap only.
+            # Directories may point straight at files, which have no label.
+            for div in element.iter(METS_NS + "div"):
+                fptrs = div.findall(METS_NS + "fptr")
+                if (div.get("TYPE") or "").lower() == "directory":
+                    for fptr in fptrs:
+                        labels.setdefault(fptr.get("FILEID"), None)
+                elif fptrs:
+                    labels.setdefault(fptrs[0].get("FILEID"), div.get("LABEL"))
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+    # Index every file in the structMap by its UUID.
+    entries = {}
+    for file_id, label in labels.items():
+        if file_id not in files:
+            continue
+        admid, path = files[file_id]
+        file_uuid = file_id[5:] if file_id.startswith("file-") else file_id[-36:]
+        premis_objects, premis_events = amdsecs.get(admid, ([], []))
+        entries.setdefault(file_uuid, (path, label, premis_objects, premis_events))
+
+    records = {}
+    for object_uuid in (entries if object_uuids is None else object_uuids):
+        if object_uuid not in entries:
+            continue
+        path, label, premis_objects, premis_events = entries[object_uuid]
+        record = new_mets_record()
+        record["relativePathWithinAip"] = path
+        record["originalFileName"] = label
+
+        for premis_event in premis_events:
+            if premis_event["type"] == "ingestion":
+                record["originalFileIngestedAt"] = parse_event_date(premis_event["dateTime"])
+        record["premisEvents"] = premis_events
+
+        for premis_object in premis_objects:
+            record["originalFileSize"] = premis_object["size"]
+            record["formatName"] = premis_object["formatName"]
+            if premis_object["formatRegistryKey"] is not None:
+                record["formatRegistryKey"] = premis_object["formatRegistryKey"]
+            if premis_object["formatVersion"] is not None:
+                record["formatVersion"] = premis_object["formatVersion"]
+
+            # If this digital object has a preservation copy, retrieve its
+            # information.
+            if premis_object["relationshipSubType"] == "is source of" and premis_object["relatedObjectUUID"] in entries:
+                preservation_path, preservation_label, preservation_objects, preservation_events = entries[premis_object["relatedObjectUUID"]]
+                record["preservationCopyFileName"] = preservation_label
+                for entry in preservation_objects:
+                    record["preservationCopyFileSize"] = entry["size"]
+                for event in preservation_events:
+                    if event["type"] == "creation":
+                        record["preservationCopyNormalizedAt"] = parse_event_date(event["dateTime"])
 
-def write_property(object_id, scope, name, value, object_uuid):
+        records[object_uuid] = record
+
+    return records
+
+
+def extract_mets_records(mets_path, object_uuids):
+    if METS_PARSER == "iterparse":
+        try:
+            return extract_mets_records_iterparse(mets_path, object_uuids)
+        except Exception as e:
+            print("Unable to stream the METS XML in " + mets_path + ". Falling back to METSRW.")
+            print(e)
+    return extract_mets_records_metsrw(mets_path, object_uuids)
+
+
+def parse_mets_values(aip_uuid, legacy_dip_files, download, records, parse_error):
+    '''
+    Report the outcome of downloading and parsing the METS file of one AIP
+    and return the working table values for its digital objects, and the
+    premis_events rows holding their PREMIS events.
+    '''
     global ERROR_COUNT
-    # Helper function to insert updated property values.
+
+    # The METS file was fetched by a download worker. Report any failure.
+    if download["error"]:
+        print(download["error"])
+        if download["exception"] is not None:
+            print(download["exception"])
+        ERROR_COUNT += 1
+        # Leave the AIP's objects unparsed, so that a resumed run retries
+        # them once the Storage Service is back.
+        return [], []
+    transfer_name = download["transfer_name"]
+
+    # The METS file was read by a parser process. Report any failure.
+    if parse_error is not None:
+        print("METSRW is unable to parse the METS XML for package " + aip_uuid + ". Check your markup and see archivematica/issues#1129.")
+        print(parse_error)
+        ERROR_COUNT += 1
+        # Leave the AIP's objects unparsed, so that their existing
+        # properties are not replaced with empty values.
+        return [], []
+
+    values = []
+    events = []
+    for file in legacy_dip_files:
+        record = records.get(file['object_uuid'])
+        if record is None:
+            print("Unable to find metadata for file " + file['object_uuid'] + " in METS." + aip_uuid + ".xml")
+            ERROR_COUNT += 1
+            continue
+        for message, detail in record["errors"]:
+            print(message)
+            print(detail)
+            ERROR_COUNT += 1
+        values.append((record["originalFileIngestedAt"], record["relativePathWithinAip"], transfer_name, record["originalFileName"], record["originalFileSize"], record["formatName"], record["formatVersion"], "PRONOM", record["formatRegistryKey"], record["preservationCopyNormalizedAt"], record["preservationCopyFileName"], record["preservationCopyFileSize"], True, file['object_id']))
+        if record["premisEvents"]:
+            # Objects with hundreds of events repeat the same agents and
+            # event types over and over, which compresses well.
+            events.append((file['object_id'], len(record["premisEvents"]), zlib.compress(json.dumps(record["premisEvents"]).encode("utf-8"))))
+    return values, events
+
+
+def write_parsed_values(values, events, aip_phases):
+    # Write the METS values and PREMIS events to the MySQL working tables,
+    # together with the phase reached by each AIP, in one transaction.
+    if values:
+        sql = "UPDATE dip_files SET originalFileIngestedAt = %s, relativePathWithinAip = %s, aipName = %s, originalFileName = %s, originalFileSize = %s, formatName = %s, formatVersion = %s, formatRegistryName = %s, formatRegistryKey = %s, preservationCopyNormalizedAt = %s, preservationCopyFileName = %s, preservationCopyFileSize = %s, parsed = %s WHERE object_id = %s;"
+        mysqlCursor.executemany(sql, values)
+    if events:
+        # A resumed run may parse an object again.
+        sql = "REPLACE INTO premis_events (object_id, event_count, events) VALUES (%s, %s, %s);"
+        mysqlCursor.executemany(sql, events)
+    if aip_phases:
+        sql = "UPDATE aip_status SET phase = %s WHERE aip_uuid = %s;"
+        mysqlCursor.executemany(sql, aip_phases)
+    record_shard_status("parsing")
+    mysqlConnection.commit()
+
+
+def php_serialize(value):
+    # Serialize strings, lists, dicts and None the way PHP's serialize()
+    # does, which is how AtoM stores array properties. Lengths are in bytes.
+    if value is None:
+        return "N;"
+    if isinstance(value, dict):
+        items = list(value.items())
+    elif isinstance(value, list):
+        items = list(enumerate(value))
+    else:
+        value = str(value)
+        return "s:" + str(len(value.encode("utf-8"))) + ":\"" + value + "\";"
+    serialized = "a:" + str(len(items)) + ":{"
+    for key, item in items:
+        serialized += ("i:" + str(key) + ";" if isinstance(key, int) else php_serialize(key)) + php_serialize(item)
+    return serialized + "}"
+
+
+def premis_event_date_time(event_date_time):
+    # AtoM keeps event dates in UTC, as "2021-04-30T15:56:27Z".
+    # Fractions of a second are dropped, as their width varies.
+    event_date_time = re.sub(r"\.\d+", "", event_date_time.replace("Z", "+00:00"))
     try:
-        sql = "INSERT INTO `property` (`object_id`, `scope`, `name`, `source_culture`) VALUES (%s, %s, %s, %s)"
-        mysqlCursor.execute(sql, (object_id, scope, name, "en"))
-        property_id = mysqlCursor.lastrowid
-        sql = "INSERT INTO `property_i18n` (`value`, `id`, `culture`) VALUES (%s, %s, %s)"
-        mysqlCursor.execute(sql, (value, property_id, "en"))
+        date_time = datetime.fromisoformat(event_date_time)
+    except ValueError:
+        date_time = parse_event_date(event_date_time)
+    if date_time.tzinfo is not None:
+        date_time = date_time.astimezone(timezone.utc)
+    return date_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def premis_event_property(event):
+    '''
+    Return the property name and value of a PREMIS event, as written by
+    AtoM 2.7 for DIP uploads. Empty fields are left out.
+    '''
+    value = {"type": event["type"]}
+    if event["dateTime"]:
+        try:
+            value["dateTime"] = premis_event_date_time(event["dateTime"])
+        except ValueError:
+            value["dateTime"] = event["dateTime"]
+    if event["outcome"]:
+        value["outcome"] = event["outcome"]
+    if event["outcomeDetailNote"]:
+        value["outcomeDetailNote"] = event["outcomeDetailNote"]
+    linking_agents = [{"type": agent["type"], "value": agent["value"]} for agent in event["linkingAgentIdentifier"] if agent["type"] or agent["value"]]
+    if linking_agents:
+        value["linkingAgentIdentifier"] = linking_agents
+    return PREMIS_EVENT_PROPERTIES.get(event["type"], PREMIS_OTHER_EVENT), php_serialize(value)
+
+
+def digital_object_properties(legacy_dip_files):
+    '''
+    Return the properties of a chunk of digital objects, as (object_id,
+    scope, name, value), including one property per PREMIS event staged in
+    the premis_events working table.
+    '''
+    object_ids = [file["object_id"] for file in legacy_dip_files]
+    sql = "SELECT object_id, events FROM premis_events WHERE object_id IN (" + ", ".join(["%s"] * len(object_ids)) + ");"
+    mysqlCursor.execute(sql, object_ids)
+    premis_events = {row["object_id"]: json.loads(zlib.decompress(row["events"])) for row in mysqlCursor.fetchall()}
+
+    properties = [
+        (file["object_id"], scope, name, file[column])
+        for file in legacy_dip_files
+        for scope, name, column in DIGITAL_OBJECT_PROPERTIES
+    ]
+    properties.extend(
+        (file["object_id"], "premisData") + premis_event_property(event)
+        for file in legacy_dip_files
+        for event in premis_events.get(file["object_id"], [])
+    )
+    return properties
+
+
+def reserve_property_ids():
+    # Reserve a block of property ids so the property_i18n rows can be built
+    # without reading back lastrowid one row at a time. The lock taken on
+    # the end of the property index holds until the chunk is committed. It
+    # is taken first so that hosts writing other shards queue up behind it
+    # instead of deadlocking on each other's deletes.
+    sql = "SELECT id FROM property ORDER BY id DESC LIMIT 1 FOR UPDATE;"
+    mysqlCursor.execute(sql)
+    last_property = mysqlCursor.fetchone()
+    return last_property["id"] + 1 if last_property else 1
+
+
+def insert_properties(first_id, properties):
+    sql = "INSERT INTO `property` (`id`, `object_id`, `scope`, `name`, `source_culture`) VALUES (%s, %s, %s, %s, %s)"
+    mysqlCursor.executemany(sql, [
+        (first_id + offset, object_id, scope, name, "en")
+        for offset, (object_id, scope, name, value) in enumerate(properties)
+    ])
+    sql = "INSERT INTO `property_i18n` (`value`, `id`, `culture`) VALUES (%s, %s, %s)"
+    mysqlCursor.executemany(sql, [
+        (value, first_id + offset, "en")
+        for offset, (object_id, scope, name, value) in enumerate(properties)
+    ])
+
+
+def mark_written(object_ids):
+    # Mark the objects as written in the same transaction, so a resumed run
+    # never replaces their properties twice.
+    sql = "UPDATE dip_files SET written = TRUE WHERE object_id IN (" + ", ".join(["%s"] * len(object_ids)) + ");"
+    mysqlCursor.execute(sql, object_ids)
+
+
+def write_properties(legacy_dip_files):
+    '''
+    Replace the properties of a chunk of digital objects, including one
+    property per PREMIS event. All statements run in the caller's
+    transaction, which must commit or roll back. Returns the number of
+    properties written.
+    '''
+    object_ids = [file["object_id"] for file in legacy_dip_files]
+    properties = digital_object_properties(legacy_dip_files)
+    first_id = reserve_property_ids()
+
+    sql = "DELETE FROM property WHERE object_id IN (" + ", ".join(["%s"] * len(object_ids)) + ");"
+    mysqlCursor.execute(sql, object_ids)
+    insert_properties(first_id, properties)
+    mark_written(object_ids)
+    return len(properties)
+
+
+def diff_properties(properties, existing_properties):
+    '''
+    Compare the properties that write_properties() would write with the
+    existing ones. Returns the differences, as (change, object_id,
+    property_id, scope, name, old_value, new_value) where change is
+    "added", "changed" or "removed", and the number of unchanged
+    properties. A new value is matched to a stale property with the same
+    scope and name, if there is one, so that it can be updated in place.
+    '''
+    remaining = {}
+    for row in existing_properties:
+        remaining.setdefault((row["object_id"], row["scope"], row["name"], row["value"]), []).append(row["id"])
+
+    unchanged_count = 0
+    new_properties = []
+    for property in properties:
+        property_ids = remaining.get(property)
+        if property_ids:
+            property_ids.pop(0)
+            unchanged_count += 1
+        else:
+            new_properties.append(property)
+
+    stale = {}
+    for (object_id, scope, name, value), property_ids in remaining.items():
+        for property_id in property_ids:
+            stale.setdefault((object_id, scope, name), []).append((property_id, value))
+
+    changes = []
+    for object_id, scope, name, value in new_properties:
+        candidates = stale.get((object_id, scope, name))
+        if candidates:
+            property_id, old_value = candidates.pop(0)
+            changes.append(("changed", object_id, property_id, scope, name, old_value, value))
+        else:
+            changes.append(("added", object_id, None, scope, name, None, value))
+    for (object_id, scope, name), candidates in stale.items():
+        for property_id, old_value in candidates:
+            changes.append(("removed", object_id, property_id, scope, name, old_value, None))
+    changes.sort(key=lambda change: change[1])
+    return changes, unchanged_count
+
+
+def write_changed_properties(legacy_dip_files):
+    '''
+    Write only the properties of a chunk of digital objects that differ
+    from the existing ones, or nothing at all in a DRY_RUN. All statements
+    run in the caller's transaction, which must commit or roll back.
+    Returns the differences and the number of unchanged properties, as
+    diff_properties() does.
+    '''
+    object_ids = [file["object_id"] for file in legacy_dip_files]
+    properties = digital_object_properties(legacy_dip_files)
+    if not DRY_RUN:
+        first_id = reserve_property_ids()
+
+    # The existing properties of the chunk in every scope, with the value
+    # written for them.
+    sql = """SELECT property.id, property.object_id, property.scope, property.name, property_i18n.value
+        FROM property
+        LEFT JOIN property_i18n ON property_i18n.id = property.id AND property_i18n.culture = 'en'
+        WHERE property.object_id IN (""" + ", ".join(["%s"] * len(object_ids)) + """)
+        ORDER BY property.id;"""
+    mysqlCursor.execute(sql, object_ids)
+    changes, unchanged_count = diff_properties(properties, mysqlCursor.fetchall())
+    if DRY_RUN:
+        return changes, unchanged_count
+
+    removed_ids = [property_id for change, object_id, property_id, scope, name, old_value, new_value in changes if change == "removed"]
+    if removed_ids:
+        sql = "DELETE FROM property WHERE id IN (" + ", ".join(["%s"] * len(removed_ids)) + ");"
+        mysqlCursor.execute(sql, removed_ids)
+    changed_values = [(new_value, property_id, "en") for change, object_id, property_id, scope, name, old_value, new_value in changes if change == "changed"]
+    if changed_values:
+        sql = "INSERT INTO `property_i18n` (`value`, `id`, `culture`) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE value = VALUES(value);"
+        mysqlCursor.executemany(sql, changed_values)
+    added = [(object_id, scope, name, new_value) for change, object_id, property_id, scope, name, old_value, new_value in changes if change == "added"]
+    if added:
+        insert_properties(first_id, added)
+    mark_written(object_ids)
+    return changes, unchanged_count
+
+
+def write_property_chunk(legacy_dip_files, diff_report):
+    '''
+    Write the properties of a chunk of digital objects in a single
+    transaction and count them in the run report. With WRITE_CHANGED_ONLY
+    or DRY_RUN the differences are also listed in the diff report.
+    '''
+    if not (WRITE_CHANGED_ONLY or DRY_RUN):
+        property_count = write_properties(legacy_dip_files)
+        record_shard_status("writing")
         mysqlConnection.commit()
-    except Exception as e:
-        print("Unable to add property `" + name + " for digital object " + object_uuid)
-        print(e)
-        ERROR_COUNT += 1
+        count_phase("write", files=len(legacy_dip_files), rows=2 * property_count)
+        return
+
+    changes, unchanged_count = write_changed_properties(legacy_dip_files)
+    record_shard_status("previewing" if DRY_RUN else "writing")
+    mysqlConnection.commit()
+
+    counts = dict.fromkeys(["added", "changed", "removed"], 0)
+    for change in changes:
+        counts[change[0]] += 1
+    # Added properties take a property and a property_i18n row, changed
+    # ones a property_i18n row and removed ones cascade from the property.
+    row_count = 0 if DRY_RUN else 2 * counts["added"] + counts["changed"] + counts["removed"]
+    count_phase("write", files=len(legacy_dip_files), rows=row_count, unchanged=unchanged_count, **counts)
+
+    object_uuids = {file["object_id"]: file["object_uuid"] for file in legacy_dip_files}
+    for change, object_id, property_id, scope, name, old_value, new_value in changes:
+        diff_report.writerow([object_id, object_uuids[object_id], change, property_id, scope, name, old_value, new_value])
+
+
+def report_unparsed_dip_files():
+    # Runs before the writes, so a resumed run lists the objects that are
+    # still unparsed rather than those of the interrupted run.
+    sql = "SELECT object_id, object_uuid, aip_uuid FROM dip_files WHERE parsed = FALSE" + working_shard_filter() + " ORDER BY aip_uuid, object_id;"
+    mysqlCursor.execute(sql)
+    unparsed = mysqlCursor.fetchall()
+    if not unparsed:
+        return
+    with open(UNPARSED_REPORT, "w", newline="") as report:
+        writer = csv.writer(report)
+        writer.writerow(["object_id", "object_uuid", "aip_uuid"])
+        for row in unparsed:
+            writer.writerow([row["object_id"], row["object_uuid"], row["aip_uuid"]])
+    count_phase("write", unparsed=len(unparsed))
+    print("Keeping the existing properties of " + str(len(unparsed)) + " legacy digital objects that could not be parsed. See " + UNPARSED_REPORT + " for details. Run again with --resume to retry them.")
 
 
 def update_digital_file_properties():
-    # Select all the legacy DIP file records from the working table.
-    sql = "SELECT * FROM dip_files;"
+    global ERROR_COUNT
+
+    # Select the parsed legacy DIP file records from the working table whose
+    # properties have not been replaced yet. Unparsed records have no values
+    # to replace them with.
+    sql = "SELECT * FROM dip_files WHERE parsed = TRUE AND written = FALSE" + working_shard_filter() + ";"
     mysqlCursor.execute(sql)
     legacy_dip_files = mysqlCursor.fetchall()
+    report_unparsed_dip_files()
+    start_time = time.monotonic()
 
-    # Loop over records in working table and insert updated property values.
-    for file in legacy_dip_files:
-        # Deleting existing properties
+    diff_report = None
+    if WRITE_CHANGED_ONLY or DRY_RUN:
+        report_file = open(PROPERTY_DIFF_REPORT, "w", newline="")
+        diff_report = csv.writer(report_file)
+        diff_report.writerow(["object_id", "object_uuid", "change", "property_id", "scope", "name", "old_value", "new_value"])
+
+    # Replace the property values of each chunk of records in one
+    # transaction, so no object is left with half of its properties.
+    for start in range(0, len(legacy_dip_files), WRITE_CHUNK_SIZE):
+        chunk = legacy_dip_files[start:start + WRITE_CHUNK_SIZE]
         try:
-            sql = "DELETE FROM property WHERE object_id = %s;"
-            mysqlCursor.execute(sql, file['object_id'])
-            mysqlConnection.commit()
+            write_property_chunk(chunk, diff_report)
+            if LIVE_PROGRESS:
+                print_progress("Written digital objects", start + len(chunk), len(legacy_dip_files), start_time)
+            continue
         except Exception as e:
-            print("Unable to flush existing property values for object# " + str(file['id']) + ". Skipping...")
+            mysqlConnection.rollback()
+            print("Unable to update properties for a chunk of " + str(len(chunk)) + " digital objects. Retrying one object at a time...")
             print(e)
-            ERROR_COUNT += 1
-            continue
-        # Write new property values from METS values
-        write_property(file["object_id"], "Archivematica AIP", "objectUUID", file["object_uuid"], file["object_uuid"])
-        write_property(file["object_id"], "Archivematica AIP", "aipUUID", file["aip_uuid"], file["object_uuid"])
-        write_property(file["object_id"], "Archivematica AIP", "relativePathWithinAip", file["relativePathWithinAip"], file["object_uuid"])
-        write_property(file["object_id"], "Archivematica AIP", "aipName", file["aipName"], file["object_uuid"])
-        write_property(file["object_id"], "Archivematica AIP", "originalFileName", file["originalFileName"], file["object_uuid"])
-        write_property(file["object_id"], "Archivematica AIP", "originalFileSize", file["originalFileSize"], file["object_uuid"])
-        write_property(file["object_id"], "Archivematica AIP", "originalFileIngestedAt", file["originalFileIngestedAt"], file["object_uuid"])
-        write_property(file["object_id"], "Archivematica AIP", "preservationCopyFileName", file["preservationCopyFileName"], file["object_uuid"])
-        write_property(file["object_id"], "Archivematica AIP", "preservationCopyFileSize", file["preservationCopyFileSize"], file["object_uuid"])
-        write_property(file["object_id"], "Archivematica AIP", "preservationCopyNormalizedAt", file["preservationCopyNormalizedAt"], file["object_uuid"])
-        write_property(file["object_id"], "premisData", "formatName", file["formatName"], file["object_uuid"])
-        write_property(file["object_id"], "premisData", "formatVersion", file["formatVersion"], file["object_uuid"])
-        write_property(file["object_id"], "premisData", "formatRegistryName", file["formatRegistryName"], file["object_uuid"])
-        write_property(file["object_id"], "premisData", "formatRegistryKey", file["formatRegistryKey"], file["object_uuid"])
+
+        # Isolate the objects that caused the chunk to fail.
+        for file in chunk:
+            try:
+                write_property_chunk([file], diff_report)
+            except Exception as e:
+                mysqlConnection.rollback()
+                print("Unable to update properties for digital object " + str(file["object_uuid"]) + ". Skipping...")
+                print(e)
+                ERROR_COUNT += 1
+        if LIVE_PROGRESS:
+            print_progress("Written digital objects", start + len(chunk), len(legacy_dip_files), start_time)
+
+    if diff_report is not None:
+        report_file.close()
+        stats = phase_stats("write")
+        print("Property changes: " + ", ".join(change + " " + str(stats.get(change, 0)) for change in ["added", "changed", "removed", "unchanged"]) + ". See " + PROPERTY_DIFF_REPORT + " for details.")
+
+    # An AIP is written once none of its objects are left to write.
+    sql = "UPDATE aip_status SET phase = 'written' WHERE NOT EXISTS (SELECT 1 FROM dip_files WHERE dip_files.aip_uuid = aip_status.aip_uuid AND dip_files.written = FALSE)" + working_shard_filter("aip_status.shard") + ";"
+    mysqlCursor.execute(sql)
+    mysqlConnection.commit()
+
 
 def delete_temporary_files():
     try:
@@ -419,7 +2107,7 @@ def delete_temporary_files():
         print(e)
 
     try:
-        sql = "DROP TABLE IF EXISTS dip_files, premis_events;"
+        sql = "DROP TABLE IF EXISTS dip_files, premis_events, aip_status, shard_status;"
         mysqlCursor.execute(sql)
         mysqlConnection.commit()
     except Exception as e:
@@ -428,4 +2116,4 @@ def delete_temporary_files():
 
 
 if __name__ == "__main__":
-    main()
+    main(parse_arguments())
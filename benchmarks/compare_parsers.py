@@ -0,0 +1,111 @@
+'''
+Check that the streaming iterparse METS extractor of am-do-2-atom-do.py
+returns the same records as the METSRW extractor, field for field:
+
+    python benchmarks/compare_parsers.py
+    python benchmarks/compare_parsers.py DIP_METS/
+
+Without a directory, synthetic AIPs with PREMIS 2 and PREMIS 3 metadata,
+extra events and preservation copies are generated in a temporary
+directory. Every file of each METS file is compared, and then a subset of
+the original files, as the script asks for. The exit status is 1 if any
+record differs. No MySQL or Storage Service connection is needed.
+'''
+import argparse
+import os
+import sys
+import tempfile
+
+from parse_benchmark import load_script, original_file_uuids
+from synthetic_mets import generate_aips
+
+# Differences printed per METS file before the rest are only counted.
+MAX_PRINTED_DIFFERENCES = 10
+
+
+def generate_mets_files(directory):
+    mets_paths = []
+    for premis in ("2", "3"):
+        bench_dir = os.path.join(directory, "premis" + premis)
+        for aip in generate_aips(bench_dir, aip_count=3, file_count=20, event_count=2, premis=premis, seed=int(premis)):
+            mets_paths.append(os.path.join(bench_dir, "METS." + aip["uuid"] + ".xml"))
+    return mets_paths
+
+
+def compare_records(iterparse_records, metsrw_records):
+    '''
+    Return the differences between the records of two extractors, as
+    (file UUID, field, iterparse value, METSRW value).
+    '''
+    differences = []
+    for file_uuid in sorted(set(iterparse_records) | set(metsrw_records)):
+        if file_uuid not in metsrw_records:
+            differences.append((file_uuid, "(record)", "present", "missing"))
+            continue
+        if file_uuid not in iterparse_records:
+            differences.append((file_uuid, "(record)", "missing", "present"))
+            continue
+        iterparse_record = iterparse_records[file_uuid]
+        metsrw_record = metsrw_records[file_uuid]
+        for field in sorted(set(iterparse_record) | set(metsrw_record)):
+            iterparse_value = iterparse_record.get(field)
+            metsrw_value = metsrw_record.get(field)
+            if iterparse_value == metsrw_value:
+                continue
+            if not (isinstance(iterparse_value, list) and isinstance(metsrw_value, list)):
+                differences.append((file_uuid, field, iterparse_value, metsrw_value))
+                continue
+            # Name the differing events or errors rather than the whole list.
+            for index in range(max(len(iterparse_value), len(metsrw_value))):
+                iterparse_item = iterparse_value[index] if index < len(iterparse_value) else None
+                metsrw_item = metsrw_value[index] if index < len(metsrw_value) else None
+                if iterparse_item != metsrw_item:
+                    differences.append((file_uuid, field + "[" + str(index) + "]", iterparse_item, metsrw_item))
+    return differences
+
+
+def compare_mets_file(script, mets_path):
+    # Compare every file, then every other original file, which exercises
+    # the lookup by object UUID that the script uses.
+    difference_count = 0
+    subset = original_file_uuids(mets_path)[::2]
+    for object_uuids in (None, subset):
+        differences = compare_records(
+            script.extract_mets_records_iterparse(mets_path, object_uuids),
+            script.extract_mets_records_metsrw(mets_path, object_uuids),
+        )
+        for file_uuid, field, iterparse_value, metsrw_value in differences[:MAX_PRINTED_DIFFERENCES]:
+            print("  " + file_uuid + " " + field + ":")
+            print("    iterparse: " + repr(iterparse_value))
+            print("    metsrw:    " + repr(metsrw_value))
+        if len(differences) > MAX_PRINTED_DIFFERENCES:
+            print("  ... and " + str(len(differences) - MAX_PRINTED_DIFFERENCES) + " more differences")
+        difference_count += len(differences)
+    return difference_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mets_dir", nargs="?", help="directory of METS.<uuid>.xml files (default: generate synthetic ones)")
+    args = parser.parse_args()
+
+    script = load_script()
+    if args.mets_dir:
+        mets_paths = [os.path.join(args.mets_dir, name) for name in sorted(os.listdir(args.mets_dir)) if name.startswith("METS.") and name.endswith(".xml")]
+    else:
+        mets_paths = generate_mets_files(tempfile.mkdtemp(prefix="compare-parsers-"))
+    if not mets_paths:
+        sys.exit("No METS files found in " + args.mets_dir)
+
+    mismatched_count = 0
+    for mets_path in mets_paths:
+        difference_count = compare_mets_file(script, mets_path)
+        print(("differs" if difference_count else "matches").ljust(9) + mets_path)
+        mismatched_count += bool(difference_count)
+    print(str(len(mets_paths) - mismatched_count) + " of " + str(len(mets_paths)) + " METS files parsed identically.")
+    if mismatched_count:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
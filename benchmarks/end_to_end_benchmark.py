@@ -0,0 +1,150 @@
+'''
+Run am-do-2-atom-do.py end to end against synthetic AIPs, a local Storage
+Service stub and a scaled AtoM fixture, and report its throughput per
+phase. Start from a local MySQL or MariaDB database loaded with
+test_data/2.7.dump.sql and the usual ATOM_MYSQL_* environment variables:
+
+    python benchmarks/synthetic_mets.py bench/ --aips 50 --files 200
+    python benchmarks/end_to_end_benchmark.py load-fixture bench/ --padding 20
+    python benchmarks/end_to_end_benchmark.py run bench/ -- --progress
+
+load-fixture adds an AtoM information object and digital object with
+legacy objectUUID and aipUUID properties for every original file of the
+synthetic AIPs. --padding adds unrelated properties per legacy object to
+scale the property tables up to the size of a production site. A run
+replaces the legacy properties, so restore the database and load the
+fixture again before the next run.
+
+run serves the AIPs from a stub Storage Service and runs the script in
+bench/run/, passing on any arguments after "--". The script's METS cache
+is emptied first unless --keep-cache is given.
+'''
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from parse_benchmark import SCRIPT, load_script
+from storage_service_stub import StorageServiceStub
+from synthetic_mets import load_aips
+
+FIXTURE_CHUNK_SIZE = 1000
+
+# Columns of the per-phase table, as (heading, report metric, format).
+PHASE_COLUMNS = [
+    ("seconds", "seconds", "{:.2f}"),
+    ("AIPs/s", "aips_per_second", "{:.1f}"),
+    ("files/s", "files_per_second", "{:.0f}"),
+    ("rows/s", "rows_per_second", "{:.0f}"),
+    ("p50", "latency_p50", "{:.3f}"),
+    ("p90", "latency_p90", "{:.3f}"),
+    ("p99", "latency_p99", "{:.3f}"),
+    ("busy", "utilization", "{:.0%}"),
+]
+
+
+def insert_chunks(cursor, sql, rows):
+    for start in range(0, len(rows), FIXTURE_CHUNK_SIZE):
+        cursor.executemany(sql, rows[start:start + FIXTURE_CHUNK_SIZE])
+
+
+def load_fixture(bench_dir, padding):
+    script = load_script()
+    connection = script.connect_atom_database()
+    cursor = connection.cursor()
+    cursor.execute("SELECT COALESCE(MAX(id), 0) AS id FROM object;")
+    next_object_id = cursor.fetchone()["id"] + 1
+    cursor.execute("SELECT COALESCE(MAX(id), 0) AS id FROM property;")
+    next_property_id = cursor.fetchone()["id"] + 1
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    object_count = 0
+    for aip in load_aips(bench_dir):
+        objects = []
+        digital_objects = []
+        properties = []
+        for object_uuid in aip["object_uuids"]:
+            information_object_id = next_object_id
+            objects.append(("QubitInformationObject", now, now, information_object_id))
+            objects.append(("QubitDigitalObject", now, now, information_object_id + 1))
+            digital_objects.append((information_object_id + 1, information_object_id, object_uuid + ".bin", "/uploads/r/synthetic/"))
+            properties.append((information_object_id, "objectUUID", object_uuid))
+            properties.append((information_object_id, "aipUUID", aip["uuid"]))
+            next_object_id += 2
+            # Unrelated properties only grow the tables; the script never
+            # reads or replaces them.
+            if padding:
+                objects.append(("QubitInformationObject", now, now, next_object_id))
+                properties.extend((next_object_id, "language", "N;") for _ in range(padding))
+                next_object_id += 1
+            object_count += 1
+
+        property_rows = [(next_property_id + offset, object_id, name) for offset, (object_id, name, value) in enumerate(properties)]
+        property_i18n_rows = [(value, next_property_id + offset) for offset, (object_id, name, value) in enumerate(properties)]
+        next_property_id += len(properties)
+
+        insert_chunks(cursor, "INSERT INTO object (class_name, created_at, updated_at, id) VALUES (%s, %s, %s, %s);", objects)
+        insert_chunks(cursor, "INSERT INTO digital_object (id, object_id, name, path) VALUES (%s, %s, %s, %s);", digital_objects)
+        insert_chunks(cursor, "INSERT INTO property (id, object_id, scope, name, source_culture) VALUES (%s, %s, NULL, %s, 'en');", property_rows)
+        insert_chunks(cursor, "INSERT INTO property_i18n (value, id, culture) VALUES (%s, %s, 'en');", property_i18n_rows)
+        connection.commit()
+    connection.close()
+    print("Loaded " + str(object_count) + " legacy digital objects into " + script.ATOM_MYSQL_DATABASE + ".")
+
+
+def print_report(report_path, elapsed, request_count):
+    with open(report_path) as report_file:
+        report = json.load(report_file)
+    written = report["phases"].get("write", {}).get("files", 0)
+    print("End to end: " + "{:.2f}".format(elapsed) + "s, " + str(written) + " digital objects written, " + "{:.1f}".format(written / elapsed) + " objects/s, " + str(report["errors"]) + " errors, " + str(request_count) + " Storage Service requests")
+    print("phase".ljust(20) + "".join(heading.rjust(10) for heading, metric, format in PHASE_COLUMNS))
+    for phase, summary in report["phases"].items():
+        cells = [format.format(summary[metric]) if metric in summary else "-" for heading, metric, format in PHASE_COLUMNS]
+        print(phase.ljust(20) + "".join(cell.rjust(10) for cell in cells))
+
+
+def run(bench_dir, latency, extract_latency, keep_cache, script_args):
+    work_dir = os.path.join(bench_dir, "run")
+    os.makedirs(work_dir, exist_ok=True)
+    if not keep_cache:
+        shutil.rmtree(os.path.join(work_dir, "DIP_METS"), ignore_errors=True)
+    report_path = os.path.join(os.path.abspath(work_dir), "run_report.json")
+
+    server = StorageServiceStub(bench_dir, latency=latency, extract_latency=extract_latency).start()
+    environment = dict(os.environ, ARCHIVEMATICA_SS_URL=server.url)
+    start = time.monotonic()
+    result = subprocess.run([sys.executable, os.path.abspath(SCRIPT), "--report", report_path] + script_args, cwd=work_dir, env=environment)
+    elapsed = time.monotonic() - start
+    server.shutdown()
+    if result.returncode != 0:
+        sys.exit("The script exited with status " + str(result.returncode) + ".")
+    print_report(report_path, elapsed, server.request_count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    fixture = commands.add_parser("load-fixture", help="add legacy digital objects for the synthetic AIPs to the AtoM database")
+    fixture.add_argument("bench_dir", help="directory written by synthetic_mets.py")
+    fixture.add_argument("--padding", type=int, default=0, help="unrelated properties per legacy digital object (default: %(default)s)")
+    runner = commands.add_parser("run", help="run the script against the Storage Service stub")
+    runner.add_argument("bench_dir", help="directory written by synthetic_mets.py")
+    runner.add_argument("--latency", type=float, default=0.0, help="seconds the stub adds to every request (default: %(default)s)")
+    runner.add_argument("--extract-latency", type=float, default=0.0, help="seconds the stub adds to METS requests of compressed packages (default: %(default)s)")
+    runner.add_argument("--keep-cache", action="store_true", help="re-use the METS files cached by an earlier run")
+    runner.add_argument("script_args", nargs=argparse.REMAINDER, help="arguments for am-do-2-atom-do.py, after --")
+    args = parser.parse_args()
+
+    if args.command == "load-fixture":
+        load_fixture(args.bench_dir, args.padding)
+    else:
+        script_args = args.script_args[1:] if args.script_args[:1] == ["--"] else args.script_args
+        run(args.bench_dir, args.latency, args.extract_latency, args.keep_cache, script_args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+'''
+Measure how the METS parse stage of am-do-2-atom-do.py scales with the
+number of parser processes. Point it at a directory of METS files, such as
+the DIP_METS/ directory left behind by an earlier run:
+
+    python benchmarks/parse_benchmark.py DIP_METS/ --workers 1 2 4 8 16
+
+Every original file listed in each METS file is parsed, as if all of them
+were legacy AtoM digital objects. No MySQL or Storage Service connection
+is needed.
+'''
+import argparse
+import importlib
+import os
+import re
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "am-do-2-atom-do.py")
+
+ORIGINAL_FILE_ID = re.compile(rb'<mets:fileGrp USE="original">(.*?)</mets:fileGrp>', re.DOTALL)
+FILE_UUID = re.compile(rb'ID="file-([0-9a-f-]{36})"')
+
+
+def load_script():
+    # The script's file name is not a valid module name. Expose it under an
+    # importable alias, also to the parser processes, which import it again.
+    alias_dir = tempfile.mkdtemp(prefix="am-do-2-atom-do-")
+    os.symlink(os.path.abspath(SCRIPT), os.path.join(alias_dir, "am_do_2_atom_do.py"))
+    sys.path.insert(0, alias_dir)
+    os.environ["PYTHONPATH"] = alias_dir + os.pathsep + os.environ.get("PYTHONPATH", "")
+    return importlib.import_module("am_do_2_atom_do")
+
+
+def original_file_uuids(mets_path):
+    with open(mets_path, "rb") as mets_file:
+        mets = mets_file.read()
+    uuids = []
+    for file_group in ORIGINAL_FILE_ID.findall(mets):
+        uuids.extend(uuid.decode() for uuid in FILE_UUID.findall(file_group))
+    return uuids
+
+
+def run(script, jobs, workers):
+    script.PARSE_WORKERS = workers
+    start = time.monotonic()
+    file_count = 0
+    with script.start_parse_pool() as pool:
+        futures = [pool.submit(script.parse_aip_mets, mets_path, object_uuids) for mets_path, object_uuids in jobs]
+        for future in futures:
+            records, error, seconds = future.result()
+            if error is not None:
+                print("Unable to parse METS file: " + error)
+                continue
+            file_count += len(records)
+    return time.monotonic() - start, file_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mets_dir", help="directory of METS.<uuid>.xml files")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1], help="parser process counts to compare")
+    args = parser.parse_args()
+
+    script = load_script()
+    jobs = []
+    for name in sorted(os.listdir(args.mets_dir)):
+        if name.startswith("METS.") and name.endswith(".xml"):
+            mets_path = os.path.join(args.mets_dir, name)
+            jobs.append((mets_path, original_file_uuids(mets_path)))
+    if not jobs:
+        sys.exit("No METS files found in " + args.mets_dir)
+    print("Parsing " + str(len(jobs)) + " METS files with " + script.METS_PARSER + " on " + str(os.cpu_count()) + " cores.")
+
+    baseline = None
+    print("workers  seconds  AIPs/s  files/s  speedup")
+    for workers in args.workers:
+        elapsed, file_count = run(script, jobs, workers)
+        baseline = baseline or elapsed
+        print("{:>7}  {:>7.2f}  {:>6.1f}  {:>7.0f}  {:>6.2f}x".format(workers, elapsed, len(jobs) / elapsed, file_count / elapsed, baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
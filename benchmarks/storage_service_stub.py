@@ -0,0 +1,144 @@
+'''
+Serve synthetic AIPs written by synthetic_mets.py through the parts of the
+Archivematica Storage Service API that am-do-2-atom-do.py uses:
+
+    python benchmarks/storage_service_stub.py bench/ --port 8000
+
+    GET /                       connection test
+    GET /file/<uuid>            package details, including current_path
+    GET /file/<uuid>/extract_file/?relative_path_to_file=<path>
+                                the METS file, if <path> is the METS path
+
+Latency can be added to every request, and extra latency to METS files of
+compressed packages, to mimic a Storage Service that unpacks the archive
+for every request. Credentials are accepted but not checked.
+'''
+import argparse
+import http.server
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from synthetic_mets import load_aips
+
+PACKAGE_URL = re.compile(r"^/file/([0-9a-f-]{36})/?$")
+EXTRACT_URL = re.compile(r"^/file/([0-9a-f-]{36})/extract_file/?$")
+
+
+def current_path(aip):
+    # Storage Service paths start with the 40 character quad directory
+    # tree of the AIP UUID, which get_mets_path() strips.
+    quads = aip["uuid"].replace("-", "")
+    path = "/".join(quads[i:i + 4] for i in range(0, 32, 4)) + "/"
+    return path + aip["name"] + "-" + aip["uuid"] + (".7z" if aip["compressed"] else "")
+
+
+class StorageServiceHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        time.sleep(server.latency)
+        server.count_request()
+
+        if url.path in ("", "/"):
+            self.send_body(200, b"{}")
+            return
+
+        match = PACKAGE_URL.match(url.path)
+        if match:
+            aip = server.aips.get(match.group(1))
+            if aip is None:
+                self.send_body(404, b'{"error": "package not found"}')
+                return
+            package = {
+                "uuid": aip["uuid"],
+                "current_path": current_path(aip),
+                "current_location": "/api/v2/location/" + aip["location"] + "/",
+                "package_type": "AIP",
+                "status": "UPLOADED",
+            }
+            self.send_body(200, json.dumps(package).encode())
+            return
+
+        match = EXTRACT_URL.match(url.path)
+        if match:
+            aip = server.aips.get(match.group(1))
+            relative_path = parse_qs(url.query).get("relative_path_to_file", [""])[0]
+            expected_path = aip["name"] + "-" + aip["uuid"] + "/data/METS." + aip["uuid"] + ".xml" if aip else None
+            if relative_path != expected_path:
+                self.send_body(404, b'{"error": "file not found in package"}')
+                return
+            if aip["compressed"]:
+                time.sleep(server.extract_latency)
+            mets_path = os.path.join(server.bench_dir, "METS." + aip["uuid"] + ".xml")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/xml")
+            self.send_header("Content-Length", str(os.path.getsize(mets_path)))
+            self.end_headers()
+            with open(mets_path, "rb") as mets_file:
+                shutil.copyfileobj(mets_file, self.wfile)
+            return
+
+        self.send_body(404, b'{"error": "not found"}')
+
+
+class StorageServiceStub(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, bench_dir, port=0, latency=0.0, extract_latency=0.0):
+        super().__init__(("127.0.0.1", port), StorageServiceHandler)
+        self.bench_dir = bench_dir
+        self.aips = {aip["uuid"]: aip for aip in load_aips(bench_dir)}
+        self.latency = latency
+        self.extract_latency = extract_latency
+        self.request_count = 0
+        self.request_count_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server_port)
+
+    def count_request(self):
+        with self.request_count_lock:
+            self.request_count += 1
+
+    def start(self):
+        # Serve from a daemon thread, for use inside another script.
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("bench_dir", help="directory written by synthetic_mets.py")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request (default: %(default)s)")
+    parser.add_argument("--extract-latency", type=float, default=0.0, help="seconds added to METS requests of compressed packages (default: %(default)s)")
+    args = parser.parse_args()
+
+    server = StorageServiceStub(args.bench_dir, args.port, args.latency, args.extract_latency)
+    print("Serving " + str(len(server.aips)) + " AIPs at " + server.url + ". Set ARCHIVEMATICA_SS_URL to this URL.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+'''
+Generate synthetic Archivematica AIP METS files for benchmarking
+am-do-2-atom-do.py offline:
+
+    python benchmarks/synthetic_mets.py bench/ --aips 50 --files 200
+
+Each AIP gets a METS.<uuid>.xml file with the given number of original
+files, PREMIS events per file and share of normalized files, in the layout
+written by Archivematica 1.12. The AIPs are listed in bench/aips.json,
+which the Storage Service stub and the AtoM fixture loader read.
+'''
+import argparse
+import json
+import os
+import random
+import uuid
+from xml.sax.saxutils import escape, quoteattr
+
+AIP_LIST = "aips.json"
+
+PREMIS_NS = {"3": "http://www.loc.gov/premis/v3", "2": "info:lc/xmlns/premis-v2"}
+
+# (type, outcome, outcome detail note) of the events recorded for every
+# original file, before the extra "validation" events.
+FILE_EVENTS = [
+    ("ingestion", "", ""),
+    ("message digest calculation", "", "0b1c3e4f"),
+    ("virus check", "Pass", ""),
+    ("format identification", "Positive", "fmt/43"),
+]
+
+FORMATS = [
+    ("JPEG File Interchange Format", "1.01", "fmt/43", "jpg"),
+    ("Portable Document Format", "1.4", "fmt/18", "pdf"),
+    ("Waveform Audio", "", "fmt/6", "wav"),
+    ("Plain Text File", "", "x-fmt/111", "txt"),
+]
+
+
+def premis_object(premis, object_uuid, name, size, format, relationship=None):
+    format_name, format_version, format_key, extension = format
+    version = "<premis:formatVersion>" + format_version + "</premis:formatVersion>" if format_version else ""
+    related = ""
+    if relationship is not None:
+        # PREMIS 2 and 3 name the related object element differently.
+        identification = "relatedObjectIdentifier" if premis == "3" else "relatedObjectIdentification"
+        related = (
+            "<premis:relationship><premis:relationshipType>derivation</premis:relationshipType>"
+            "<premis:relationshipSubType>" + relationship[0] + "</premis:relationshipSubType>"
+            "<premis:" + identification + "><premis:relatedObjectIdentifierType>UUID</premis:relatedObjectIdentifierType>"
+            "<premis:relatedObjectIdentifierValue>" + relationship[1] + "</premis:relatedObjectIdentifierValue></premis:" + identification + ">"
+            "</premis:relationship>"
+        )
+    return (
+        '<mets:techMD ID="techMD_' + object_uuid + '"><mets:mdWrap MDTYPE="PREMIS:OBJECT"><mets:xmlData>'
+        '<premis:object xmlns:premis="' + PREMIS_NS[premis] + '" xsi:type="premis:file" version="' + ("3.0" if premis == "3" else "2.2") + '">'
+        "<premis:objectIdentifier><premis:objectIdentifierType>UUID</premis:objectIdentifierType>"
+        "<premis:objectIdentifierValue>" + object_uuid + "</premis:objectIdentifierValue></premis:objectIdentifier>"
+        "<premis:objectCharacteristics><premis:compositionLevel>0</premis:compositionLevel>"
+        "<premis:fixity><premis:messageDigestAlgorithm>sha256</premis:messageDigestAlgorithm>"
+        "<premis:messageDigest>" + "0" * 64 + "</premis:messageDigest></premis:fixity>"
+        "<premis:size>" + str(size) + "</premis:size>"
+        "<premis:format><premis:formatDesignation><premis:formatName>" + format_name + "</premis:formatName>" + version + "</premis:formatDesignation>"
+        "<premis:formatRegistry><premis:formatRegistryName>PRONOM</premis:formatRegistryName>"
+        "<premis:formatRegistryKey>" + format_key + "</premis:formatRegistryKey></premis:formatRegistry></premis:format>"
+        "</premis:objectCharacteristics>"
+        "<premis:originalName>" + escape("%transferDirectory%objects/" + name) + "</premis:originalName>"
+        + related +
+        "</premis:object></mets:xmlData></mets:mdWrap></mets:techMD>"
+    )
+
+
+def premis_event(premis, event_id, event_type, date_time, outcome="", note=""):
+    return (
+        '<mets:digiprovMD ID="digiprovMD_' + event_id + '"><mets:mdWrap MDTYPE="PREMIS:EVENT"><mets:xmlData>'
+        '<premis:event xmlns:premis="' + PREMIS_NS[premis] + '" version="' + ("3.0" if premis == "3" else "2.2") + '">'
+        "<premis:eventIdentifier><premis:eventIdentifierType>UUID</premis:eventIdentifierType>"
+        "<premis:eventIdentifierValue>" + event_id + "</premis:eventIdentifierValue></premis:eventIdentifier>"
+        "<premis:eventType>" + event_type + "</premis:eventType>"
+        "<premis:eventDateTime>" + date_time + "</premis:eventDateTime>"
+        '<premis:eventDetailInformation><premis:eventDetail>program="synthetic"; version="1.0"</premis:eventDetail></premis:eventDetailInformation>'
+        "<premis:eventOutcomeInformation><premis:eventOutcome>" + outcome + "</premis:eventOutcome>"
+        "<premis:eventOutcomeDetail><premis:eventOutcomeDetailNote>" + escape(note) + "</premis:eventOutcomeDetailNote></premis:eventOutcomeDetail></premis:eventOutcomeInformation>"
+        "<premis:linkingAgentIdentifier><premis:linkingAgentIdentifierType>preservation system</premis:linkingAgentIdentifierType>"
+        "<premis:linkingAgentIdentifierValue>Archivematica-1.12</premis:linkingAgentIdentifierValue></premis:linkingAgentIdentifier>"
+        "<premis:linkingAgentIdentifier><premis:linkingAgentIdentifierType>repository code</premis:linkingAgentIdentifierType>"
+        "<premis:linkingAgentIdentifierValue>synthetic</premis:linkingAgentIdentifierValue></premis:linkingAgentIdentifier>"
+        "</premis:event></mets:xmlData></mets:mdWrap></mets:digiprovMD>"
+    )
+
+
+def generate_mets(aip_uuid, aip_name, file_count, event_count, normalized, premis, rng):
+    '''
+    Return the METS document of one synthetic AIP and the UUIDs of its
+    original files.
+    '''
+    def new_uuid():
+        return str(uuid.UUID(int=rng.getrandbits(128)))
+
+    amdsecs = []
+    originals = []
+    preservation_copies = []
+    divs = []
+    object_uuids = []
+    for index in range(file_count):
+        object_uuid = new_uuid()
+        object_uuids.append(object_uuid)
+        format = FORMATS[index % len(FORMATS)]
+        # Some names need escaping in the METS and URL quoting in FLocat.
+        name = ("file {} ü%.".format(index) if index % 3 == 0 else "file_{}.".format(index)) + format[3]
+        amdsec_id = "amdSec_" + str(len(amdsecs) + 1)
+
+        events = [premis_event(premis, new_uuid(), event_type, "2021-04-22T19:0{}:46.572565+00:00".format(position % 10), outcome, note) for position, (event_type, outcome, note) in enumerate(FILE_EVENTS)]
+        events.extend(premis_event(premis, new_uuid(), "validation", "2021-04-22T19:10:00+00:00", "pass") for _ in range(event_count))
+        preservation_uuid = new_uuid() if rng.random() < normalized else None
+        relationship = None
+        if preservation_uuid is not None:
+            events.append(premis_event(premis, new_uuid(), "normalization", "2021-04-22T19:04:15.600692+00:00", "", "%SIPDirectory%objects/" + preservation_uuid + ".tif"))
+            relationship = ("is source of", preservation_uuid)
+        amdsecs.append('<mets:amdSec ID="' + amdsec_id + '">' + premis_object(premis, object_uuid, name, 1000 + index, format, relationship) + "".join(events) + "</mets:amdSec>")
+        href = ("objects/" + name).replace("%", "%25").replace(" ", "%20")
+        originals.append('<mets:file GROUPID="Group-' + object_uuid + '" ID="file-' + object_uuid + '" ADMID="' + amdsec_id + '"><mets:FLocat xlink:href=' + quoteattr(href) + ' LOCTYPE="OTHER" OTHERLOCTYPE="SYSTEM"/></mets:file>')
+        divs.append("<mets:div LABEL=" + quoteattr(name) + ' TYPE="Item"><mets:fptr FILEID="file-' + object_uuid + '"/></mets:div>')
+
+        if preservation_uuid is not None:
+            preservation_name = "file_{}-{}.tif".format(index, preservation_uuid)
+            amdsec_id = "amdSec_" + str(len(amdsecs) + 1)
+            amdsecs.append('<mets:amdSec ID="' + amdsec_id + '">' + premis_object(premis, preservation_uuid, preservation_name, 2000 + index, ("Tagged Image File Format", "", "fmt/353", "tif"), ("has source", object_uuid)) + premis_event(premis, new_uuid(), "creation", "2021-04-22T19:05:15.600692+00:00") + "</mets:amdSec>")
+            preservation_copies.append('<mets:file GROUPID="Group-' + object_uuid + '" ID="file-' + preservation_uuid + '" ADMID="' + amdsec_id + '"><mets:FLocat xlink:href="objects/' + preservation_name + '" LOCTYPE="OTHER" OTHERLOCTYPE="SYSTEM"/></mets:file>')
+            divs.append('<mets:div LABEL="' + preservation_name + '" TYPE="Item"><mets:fptr FILEID="file-' + preservation_uuid + '"/></mets:div>')
+
+    mets = (
+        "<?xml version='1.0' encoding='UTF-8'?>\n"
+        '<mets:mets xmlns:mets="http://www.loc.gov/METS/" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        'xsi:schemaLocation="http://www.loc.gov/METS/ http://www.loc.gov/standards/mets/version1121/mets.xsd">'
+        '<mets:metsHdr CREATEDATE="2021-04-22T19:06:00"/>'
+        + "".join(amdsecs) +
+        '<mets:fileSec><mets:fileGrp USE="original">' + "".join(originals) + "</mets:fileGrp>"
+        '<mets:fileGrp USE="preservation">' + "".join(preservation_copies) + "</mets:fileGrp></mets:fileSec>"
+        '<mets:structMap ID="structMap_1" LABEL="Archivematica default" TYPE="physical">'
+        '<mets:div LABEL="' + aip_name + "-" + aip_uuid + '" TYPE="Directory"><mets:div LABEL="objects" TYPE="Directory">' + "".join(divs) + "</mets:div></mets:div>"
+        "</mets:structMap></mets:mets>"
+    )
+    return mets, object_uuids
+
+
+def generate_aips(bench_dir, aip_count, file_count, event_count=0, normalized=0.5, compressed=0.5, premis="3", seed=1):
+    '''
+    Write the METS files of aip_count synthetic AIPs to bench_dir and list
+    them in its AIP_LIST. Returns the AIP list.
+    '''
+    rng = random.Random(seed)
+    os.makedirs(bench_dir, exist_ok=True)
+    aips = []
+    for index in range(aip_count):
+        aip_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+        aip_name = "synthetic-aip-" + str(index)
+        mets, object_uuids = generate_mets(aip_uuid, aip_name, file_count, event_count, normalized, premis, rng)
+        with open(os.path.join(bench_dir, "METS." + aip_uuid + ".xml"), "w", encoding="utf-8") as mets_file:
+            mets_file.write(mets)
+        aips.append({
+            "uuid": aip_uuid,
+            "name": aip_name,
+            "compressed": rng.random() < compressed,
+            "location": "location-" + str(index % 2),
+            "object_uuids": object_uuids,
+        })
+    with open(os.path.join(bench_dir, AIP_LIST), "w") as aip_list:
+        json.dump(aips, aip_list)
+    return aips
+
+
+def load_aips(bench_dir):
+    with open(os.path.join(bench_dir, AIP_LIST)) as aip_list:
+        return json.load(aip_list)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("bench_dir", help="directory to write the METS files and " + AIP_LIST + " to")
+    parser.add_argument("--aips", type=int, default=10, help="number of AIPs (default: %(default)s)")
+    parser.add_argument("--files", type=int, default=100, help="original files per AIP (default: %(default)s)")
+    parser.add_argument("--events", type=int, default=0, help="extra PREMIS events per original file (default: %(default)s)")
+    parser.add_argument("--normalized", type=float, default=0.5, help="share of original files with a preservation copy (default: %(default)s)")
+    parser.add_argument("--compressed", type=float, default=0.5, help="share of AIPs stored as compressed packages (default: %(default)s)")
+    parser.add_argument("--premis", choices=sorted(PREMIS_NS), default="3", help="PREMIS version (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed, for repeatable AIPs (default: %(default)s)")
+    args = parser.parse_args()
+
+    aips = generate_aips(args.bench_dir, args.aips, args.files, args.events, args.normalized, args.compressed, args.premis, args.seed)
+    size = sum(os.path.getsize(os.path.join(args.bench_dir, "METS." + aip["uuid"] + ".xml")) for aip in aips)
+    print("Wrote " + str(len(aips)) + " METS files (" + str(size) + " bytes, " + str(len(aips) * args.files) + " original files) to " + args.bench_dir)
+
+
+if __name__ == "__main__":
+    main()